@@ -0,0 +1,336 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+BENCHMARK:
+----------
+
+Runs the full FTS pipeline replaying the recorded FTS responses in tests/fixtures/input so no network is
+needed. Reports wall time, CPU time and peak memory per stage and per country along
+with micro-benchmarks of hot functions and compares them with a stored baseline.
+
+'''
+import argparse
+import json
+import logging
+import time
+import timeit
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from os.path import join, exists
+from statistics import median
+
+from hdx import hdx_locations
+from hdx.data.vocabulary import Vocabulary
+from hdx.hdx_configuration import Configuration
+from hdx.location.country import Country
+from hdx.utilities.compare import assert_files_same
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import temp_dir
+from hdx.utilities.saver import save_json
+
+from fts.archive import ReplayDownload, ResponseArchive
+from fts.download import FTSDownload
+from fts.flows import Flows
+from fts.locations import Locations
+from fts.main import FTS
+from fts.requirements_funding import RequirementsFunding
+from fts.requirements_funding_covid import RequirementsFundingCovid
+
+logger = logging.getLogger(__name__)
+
+fixtures_folder = join('tests', 'fixtures')
+# stage name: methods timed as that stage
+stages = {
+    'locations': [(Locations, '__init__')],
+    'plans': [(FTS, 'get_plans')],
+    'covid_funding': [(RequirementsFundingCovid, 'get_covid_funding')],
+    'flows': [(Flows, 'collect_rows'), (Flows, 'write_resources')],
+    'requirements_funding': [(RequirementsFunding, 'generate_resource')],
+    'cluster_covid': [(FTS, 'call_others'), (FTS, 'generate_other_resources')],
+}
+
+
+class StageTimer:
+    '''Times stages. Wall and CPU times are exclusive of nested stages. Peak memory is the peak traced while a stage
+    runs including nested stages and needs tracemalloc.reset_peak (Python 3.9+).'''
+
+    def __init__(self):
+        self.stack = list()
+        self.country = None
+        self.totals = dict()
+        self.by_country = dict()
+        self.trace_peaks = hasattr(tracemalloc, 'reset_peak')
+
+    def add(self, results, stage, wall, cpu, peak):
+        result = results.get(stage)
+        if result is None:
+            result = {'wall': 0.0, 'cpu': 0.0, 'peak': None, 'calls': 0}
+            results[stage] = result
+        result['wall'] += wall
+        result['cpu'] += cpu
+        result['calls'] += 1
+        if peak is not None:
+            result['peak'] = max(result['peak'] or 0, peak)
+
+    @contextmanager
+    def stage(self, name):
+        frame = {'child_wall': 0.0, 'child_cpu': 0.0, 'peak': 0}
+        if self.trace_peaks:
+            self.update_parent_peak()
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        frame['base'] = base
+        self.stack.append(frame)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            self.stack.pop()
+            if self.trace_peaks:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1] - base)
+                peak = frame['peak']
+            else:
+                peak = None
+            if self.stack:
+                parent = self.stack[-1]
+                parent['child_wall'] += wall
+                parent['child_cpu'] += cpu
+                if peak is not None:
+                    parent['peak'] = max(parent['peak'], peak + base - parent['base'])
+            wall -= frame['child_wall']
+            cpu -= frame['child_cpu']
+            self.add(self.totals, name, wall, cpu, peak)
+            if self.country:
+                self.add(self.by_country.setdefault(self.country, dict()), name, wall, cpu, peak)
+
+    def update_parent_peak(self):
+        if self.stack:
+            parent = self.stack[-1]
+            parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1] - parent['base'])
+
+    def wrap(self, name, function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+
+@contextmanager
+def instrument(timer):
+    originals = list()
+    for name, methods in stages.items():
+        for cls, method in methods:
+            original = getattr(cls, method)
+            originals.append((cls, method, original))
+            setattr(cls, method, timer.wrap(name, original))
+    try:
+        yield
+    finally:
+        for cls, method, original in originals:
+            setattr(cls, method, original)
+
+
+def setup_configuration():
+    Configuration._create(hdx_read_only=True, user_agent='benchmark',
+                          project_config_yaml=join('tests', 'config', 'project_configuration.yml'))
+    hdx_locations.Locations.set_validlocations([{'name': 'afg', 'title': 'Afghanistan'},
+                                                {'name': 'jor', 'title': 'Jordan'},
+                                                {'name': 'pse', 'title': 'occupied Palestinian territory'}])
+    Country.countriesdata(False)
+    tags = ['hxl', 'financial tracking service - fts', 'aid funding', 'epidemics and outbreaks', 'covid-19']
+    Vocabulary._approved_vocabulary = {'tags': [{'name': tag} for tag in tags],
+                                       'id': '4e61d464-4943-4e97-973a-84673c1aaa87', 'name': 'approved'}
+    # Tags are all approved so the tag cleanup spreadsheet is not needed
+    Vocabulary.set_tagsdict({tag: {'Action to Take': 'ok', 'New Tag(s)': tag} for tag in tags})
+    return Configuration.read()
+
+
+def make_archive(folder):
+    '''Make an archive of the recorded FTS responses to replay'''
+    archive_path = join(folder, 'responses.zip')
+    with ResponseArchive(archive_path) as archive:
+        archive.add_folder(join(fixtures_folder, 'input'))
+    return archive_path
+
+
+def run_pipeline(configuration, archive_path, timer, check_outputs):
+    with ReplayDownload(archive_path) as downloader:
+        ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+        locations = Locations(ftsdownloader)
+        fts = FTS(ftsdownloader, locations, parse_date('2020-10-12'), configuration['notes'], start_year=2019)
+        with temp_dir('FTS-BENCHMARK') as folder:
+            for country in locations.countries:
+                timer.country = country['iso3']
+                with timer.stage('dataset'):
+                    _, _, _, ordered_resource_names = fts.generate_dataset_and_showcase(folder, country)
+                timer.country = None
+                if check_outputs:
+                    for resource_name in ordered_resource_names:
+                        assert_files_same(join(fixtures_folder, resource_name), join(folder, resource_name))
+
+
+def median_or_none(values):
+    values = list(values)
+    if None in values:
+        return None
+    return median(values)
+
+
+def get_recorded_flows(downloader):
+    flows = list()
+    for filename in sorted(downloader.names):
+        if filename.startswith('flow_'):
+            flows.extend(json.loads(downloader.zipfile.read(filename))['data']['flows'])
+    return flows
+
+
+def micro_flatten_flow(ftsdownloader):
+    flows = Flows(ftsdownloader, Locations(ftsdownloader), dict())
+    recorded_flows = get_recorded_flows(ftsdownloader.downloader)
+
+    def run():
+        for flow in recorded_flows:
+            flows.flatten_flow(flow)
+    return run
+
+
+def micro_derive_rows(ftsdownloader):
+    configuration = Configuration.read()
+    fts = FTS(ftsdownloader, Locations(ftsdownloader), parse_date('2020-10-12'), configuration['notes'],
+              start_year=2019)
+    plan_rows = [row for countryiso, plans_by_year in fts.plans_by_year_by_country.items()
+                 for year, plans in plans_by_year.items()
+                 for row in fts.reqfund.get_plan_rows(plans, year, countryiso)[0]]
+
+    def run():
+        others_rows = {key: list() for key in fts.others}
+        for row in plan_rows:
+            fts.call_others(others_rows, row)
+        return others_rows
+    # download the cluster and COVID data of the plans so that only deriving rows is timed
+    run()
+    return run
+
+
+# micro-benchmark name: function taking an FTSDownload that returns the function to time
+micro_benchmarks = {
+    'flatten_flow': micro_flatten_flow,
+    'derive_rows': micro_derive_rows,
+}
+
+
+def run_micro_benchmarks(configuration, archive_path, repeat, number=10):
+    '''Return the median time of each micro-benchmark and the peak memory allocated by one run of it'''
+    results = dict()
+    peaks = dict()
+    with ReplayDownload(archive_path) as downloader:
+        ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+        for name, setup in micro_benchmarks.items():
+            function = setup(ftsdownloader)
+            results[name] = median(timeit.repeat(function, number=number, repeat=repeat)) / number
+            tracemalloc.start()
+            function()
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return results, peaks
+
+
+def summarise(runs):
+    summary = {'stages': dict(), 'countries': dict()}
+    for stage in runs[0].totals:
+        summary['stages'][stage] = {key: median_or_none(run.totals[stage][key] for run in runs)
+                                    for key in ('wall', 'cpu', 'peak')}
+    for countryiso in runs[0].by_country:
+        summary['countries'][countryiso] = {
+            stage: {key: median(run.by_country[countryiso][stage][key] for run in runs) for key in ('wall', 'cpu')}
+            for stage in runs[0].by_country[countryiso]}
+    summary['total_wall'] = median(sum(result['wall'] for result in run.totals.values()) for run in runs)
+    return summary
+
+
+def compare(name, time, basetime, threshold, regressions):
+    if not basetime:
+        return ''
+    ratio = time / basetime
+    if ratio > 1 + threshold:
+        regressions.append(name)
+    return '%+.0f%%' % ((ratio - 1) * 100)
+
+
+def report(summary, baseline=None, threshold=0.2):
+    regressions = list()
+    if baseline is None:
+        baseline = dict()
+    lines = ['%-22s %10s %10s %12s %10s' % ('stage', 'wall ms', 'cpu ms', 'peak KiB', 'vs base')]
+    for stage, result in summary['stages'].items():
+        base = baseline.get('stages', dict()).get(stage, dict())
+        comparison = compare(stage, result['wall'], base.get('wall'), threshold, regressions)
+        peak = 'n/a' if result['peak'] is None else '%.1f' % (result['peak'] / 1024)
+        lines.append('%-22s %10.2f %10.2f %12s %10s' % (stage, result['wall'] * 1000, result['cpu'] * 1000, peak,
+                                                        comparison))
+    lines.append('%-22s %10.2f' % ('total', summary['total_wall'] * 1000))
+    for countryiso, results in summary['countries'].items():
+        timings = ', '.join(f'{stage} {result["wall"] * 1000:.2f}ms' for stage, result in results.items())
+        lines.append(f'{countryiso}: {timings}')
+    for name, result in summary.get('micro', dict()).items():
+        comparison = compare(name, result, baseline.get('micro', dict()).get(name), threshold, regressions)
+        peak = summary.get('micro_peak', dict()).get(name)
+        peak = '' if peak is None else '%.1f' % (peak / 1024)
+        lines.append('%-22s %10.2f %10s %12s %10s' % (name, result * 1000, '', peak, comparison))
+    for line in lines:
+        logger.info(line)
+    if regressions:
+        logger.warning(f'Stages or micro-benchmarks more than {threshold:.0%} slower than baseline: {", ".join(regressions)}')
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', default=5, type=int, help='Number of runs (median is reported)')
+    parser.add_argument('-b', '--baseline', default='benchmark_baseline.json', help='Baseline file')
+    parser.add_argument('-s', '--save-baseline', default=False, action='store_true', help='Save results as baseline')
+    parser.add_argument('-t', '--threshold', default=0.2, type=float, help='Slowdown reported as a regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('fts').setLevel(logging.CRITICAL)
+    configuration = setup_configuration()
+    runs = list()
+    with temp_dir('FTS-BENCHMARK-RESPONSES') as folder:
+        archive_path = make_archive(folder)
+        tracemalloc.start()
+        try:
+            for i in range(args.repeat):
+                timer = StageTimer()
+                with instrument(timer):
+                    run_pipeline(configuration, archive_path, timer, check_outputs=i == 0)
+                runs.append(timer)
+            tracemalloc.stop()
+            micro, micro_peaks = run_micro_benchmarks(configuration, archive_path, args.repeat)
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+    summary = summarise(runs)
+    summary['micro'] = micro
+    summary['micro_peak'] = micro_peaks
+    baseline = None
+    if exists(args.baseline) and not args.save_baseline:
+        baseline = load_json(args.baseline)
+    regressions = report(summary, baseline, args.threshold)
+    if args.save_baseline:
+        save_json(summary, args.baseline)
+        logger.info(f'Saved baseline to {args.baseline}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
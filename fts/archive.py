@@ -0,0 +1,96 @@
+import json
+from datetime import timedelta
+from os import listdir
+from os.path import join
+from threading import Lock
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from hdx.utilities.downloader import DownloadError
+
+from fts.download import FTSDownload, FTSException
+
+index_name = 'index.json'
+
+
+class ResponseArchive:
+    '''Records FTS responses into one compressed zip archive. Each response is stored under the name --testfolder
+    would give its file and the archive has an index of the urls requested to those names. The index is written on
+    closing so the archive must be closed even if recording fails for what was recorded to be replayable.'''
+
+    def __init__(self, path):
+        self.zipfile = ZipFile(path, 'w', compression=ZIP_DEFLATED)
+        self.index = dict()
+        # url recorded under each name
+        self.names = dict()
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, url, name, json_object):
+        with self.lock:
+            if name in self.names:
+                if self.names[name] != url:
+                    raise FTSException(f'{url} and {self.names[name]} would both be recorded as {name}!')
+                return
+            self.zipfile.writestr(name, json.dumps(json_object))
+            self.index[url] = name
+            self.names[name] = url
+
+    def add_folder(self, folder):
+        '''Add the files of a folder output by --testfolder'''
+        for filename in sorted(listdir(folder)):
+            if filename.endswith('.json'):
+                with self.lock:
+                    self.zipfile.write(join(folder, filename), filename)
+                    self.names[filename] = None
+
+    def close(self):
+        with self.lock:
+            if self.zipfile is None:
+                return
+            self.zipfile.writestr(index_name, json.dumps(self.index, indent=1, sort_keys=True))
+            self.zipfile.close()
+            self.zipfile = None
+
+
+class ReplayResponse:
+    def __init__(self, content):
+        self.content = content
+        self.elapsed = timedelta(0)
+
+
+class ReplayDownload:
+    '''Replays responses from an archive written by ResponseArchive in place of hdx Download. A url is looked up in the
+    archive's index and failing that by the name --testfolder would give its file, so that archives of test data
+    work with FTSDownload's testpath mode and rewritten nextLinks.'''
+
+    def __init__(self, path):
+        self.zipfile = ZipFile(path)
+        self.names = set(self.zipfile.namelist())
+        if index_name in self.names:
+            self.index = json.loads(self.zipfile.read(index_name))
+        else:
+            self.index = dict()
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def download(self, url):
+        name = self.index.get(url)
+        if name is None:
+            name = FTSDownload.get_testfile_path(None, url)
+        if name not in self.names:
+            raise DownloadError(f'{url} is not in the archive!')
+        with self.lock:
+            return ReplayResponse(self.zipfile.read(name))
+
+    def close(self):
+        self.zipfile.close()
@@ -1,32 +1,246 @@
-import copy
-from os.path import join, basename
+import asyncio
+import contextvars
+import gzip
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from hashlib import sha1
+from json import loads
+from os import listdir, makedirs, remove, replace, stat, utime
+from os.path import join, basename, exists
+from shutil import rmtree
+from threading import Lock, get_ident
 from urllib.parse import urlsplit
 
 from hdx.utilities.saver import save_json
+from ratelimit import RateLimitDecorator, sleep_and_retry
 from slugify import slugify
 
+from fts.requeststats import RequestStats, current_country, get_endpoint_family, no_country
+
+logger = logging.getLogger(__name__)
+
+hour = 60 * 60
+day = 24 * hour
+# Time to live in seconds of cached responses by url pattern: (pattern, ttl for years before the previous year, ttl
+# otherwise). A year captured by the pattern is compared with the current year. The previous year's data is still
+# being reported and corrected so it gets the shorter ttl. The first pattern that matches is used.
+cache_ttls = [
+    (r'/location$', 7 * day, 7 * day),
+    (r'fts/flow/plan/overview/progress/(\d{4})$', 7 * day, hour),
+    (r'country/\d+/summary/trends/(\d{4})$', day, hour),
+    (r'fts/flow\?locationid=\d+&year=(\d{4})', 7 * day, hour),
+]
+default_cache_ttl = hour
+
 
 class FTSException(Exception):
     pass
 
 
+def get_response_filename(url):
+    return f'{sha1(url.encode("utf-8")).hexdigest()}.json.gz'
+
+
+class FTSCache:
+    def __init__(self, folder, max_size=1024 * 1024 * 1024, ttls=cache_ttls, default_ttl=default_cache_ttl):
+        self.folder = folder
+        makedirs(folder, exist_ok=True)
+        self.max_size = max_size
+        self.ttls = [(re.compile(pattern), past_ttl, ttl) for pattern, past_ttl, ttl in ttls]
+        self.default_ttl = default_ttl
+        self.lock = Lock()
+        self.size = sum(stat(join(folder, filename)).st_size for filename in self.get_filenames())
+        self.hits = 0
+        self.misses = 0
+
+    def get_filenames(self):
+        return [filename for filename in listdir(self.folder) if filename.endswith('.json.gz')]
+
+    def get_path(self, url):
+        return join(self.folder, get_response_filename(url))
+
+    def get_ttl(self, url):
+        for pattern, past_ttl, ttl in self.ttls:
+            match = pattern.search(url)
+            if match is None:
+                continue
+            if match.groups() and int(match.group(1)) < datetime.now().year - 1:
+                return past_ttl
+            return ttl
+        return self.default_ttl
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, url):
+        path = self.get_path(url)
+        try:
+            mtime = stat(path).st_mtime
+            if time.time() - mtime > self.get_ttl(url):
+                self.count(False)
+                return None
+            with open(path, 'rb') as f:
+                content = gzip.decompress(f.read())
+            # access time is used for least recently used eviction, modification time for time to live
+            utime(path, (time.time(), mtime))
+        except (OSError, EOFError):
+            self.count(False)
+            return None
+        self.count(True)
+        return content
+
+    def set(self, url, content):
+        path = self.get_path(url)
+        temppath = f'{path}.{get_ident()}.tmp'
+        with open(temppath, 'wb') as f:
+            f.write(gzip.compress(content))
+        with self.lock:
+            if exists(path):
+                self.size -= stat(path).st_size
+            replace(temppath, path)
+            self.size += stat(path).st_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        paths = [join(self.folder, filename) for filename in self.get_filenames()]
+        for path in sorted(paths, key=lambda x: stat(x).st_atime):
+            if self.size <= self.max_size * 0.9:
+                break
+            self.size -= stat(path).st_size
+            remove(path)
+
+
+class FTSCheckpoint:
+    '''Keeps every response for the countries being generated, by the country requests are for (see
+    RequestStats.country), until done is called for the country so that a resumed run only requests what had not
+    finished. Unlike FTSCache there is no time to live.'''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.hits = 0
+
+    def get_path(self, url, create=False):
+        folder = join(self.folder, current_country.get() or no_country)
+        if create:
+            makedirs(folder, exist_ok=True)
+        return join(folder, get_response_filename(url))
+
+    def get(self, url):
+        try:
+            with open(self.get_path(url), 'rb') as f:
+                content = gzip.decompress(f.read())
+        except (OSError, EOFError):
+            return None
+        self.hits += 1
+        return content
+
+    def set(self, url, content):
+        path = self.get_path(url, create=True)
+        # move a temporary file into place so that a crash never leaves a partial response
+        temppath = f'{path}.{get_ident()}.tmp'
+        with open(temppath, 'wb') as f:
+            f.write(gzip.compress(content))
+        replace(temppath, path)
+
+    def done(self, countryiso):
+        rmtree(join(self.folder, countryiso), ignore_errors=True)
+
+
+def select_json(json, select):
+    '''Keep only the parts of json given by select, a dictionary of the keys to keep whose values are None to keep
+    everything under a key or a dictionary to select from what is under it. Lists are selected from element-wise.'''
+    if select is None:
+        return json
+    if isinstance(json, list):
+        return [select_json(element, select) for element in json]
+    if isinstance(json, dict):
+        return {key: json[key] if subselect is None else select_json(json[key], subselect)
+                for key, subselect in select.items() if key in json}
+    return json
+
+
 class FTSDownload:
-    def __init__(self, configuration, downloader, countryisos=None, years=None, testfolder=None, testpath=False):
+    '''Downloads from FTS. hdx Download keeps the response it is returning on itself so a downloader is only used by
+    one thread at a time. If create_downloader is given, it is called to make another downloader whenever a request
+    is made while the others are in use so that requests overlap, otherwise requests are made one at a time with
+    downloader. If rate_limit is given, requests of all downloaders together are limited to rate_limit['calls'] every
+    rate_limit['period'] seconds.'''
+
+    def __init__(self, configuration, downloader, countryisos=None, years=None, testfolder=None, testpath=False,
+                 cache=None, max_concurrent=4, stats=None, archive=None, checkpoint=None, create_downloader=None,
+                 rate_limit=None):
         self.v1_url = configuration['v1_url']
         self.v2_url = configuration['v2_url']
         self.test_url = configuration['test_url']
         self.downloader = downloader
+        self.create_downloader = create_downloader
+        self.downloader_lock = Lock()
+        # downloaders not being used and those made by create_downloader which are closed by close
+        self.free_downloaders = [downloader]
+        self.created_downloaders = list()
+        if rate_limit is None:
+            self.rate_limiter = None
+        else:
+            self.rate_limiter = sleep_and_retry(RateLimitDecorator(calls=rate_limit['calls'],
+                                                                   period=rate_limit['period'])(lambda: None))
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.max_concurrent = max_concurrent
+        if stats is None:
+            stats = RequestStats()
+        self.stats = stats
         if countryisos:
-            self.countryisos = countryisos.split(',')
+            self.countryisos = set(countryisos.split(','))
         else:
             self.countryisos = None
         if years:
-            self.years = years.split(',')
+            self.years = set(years.split(','))
         else:
             self.years = None
         self.testfolder = testfolder
+        self.archive = archive
         self.testpath = testpath
 
+    @contextmanager
+    def get_downloader(self):
+        '''Give the calling thread a downloader that no other thread is using'''
+        if self.create_downloader is None:
+            with self.downloader_lock:
+                yield self.downloader
+            return
+        with self.downloader_lock:
+            if self.free_downloaders:
+                downloader = self.free_downloaders.pop()
+            else:
+                downloader = None
+        if downloader is None:
+            downloader = self.create_downloader()
+            with self.downloader_lock:
+                self.created_downloaders.append(downloader)
+        try:
+            yield downloader
+        finally:
+            with self.downloader_lock:
+                self.free_downloaders.append(downloader)
+
+    def close(self):
+        '''Close the downloaders made by create_downloader'''
+        with self.downloader_lock:
+            for downloader in self.created_downloaders:
+                downloader.close()
+                self.free_downloaders.remove(downloader)
+            self.created_downloaders = list()
+
     def get_url(self, partial_url, use_v2=False):
         if use_v2:
             return f'{self.v2_url}{partial_url}'
@@ -46,13 +260,77 @@ class FTSDownload:
             filename = f'{filename}.json'
         return filename
 
-    def download(self, partial_url=None, data=True, use_v2=False, url=None):
+    def include_plan(self, plan):
+        if self.countryisos:
+            countries = plan['countries']
+            if countries and not any(country['iso3'] in self.countryisos for country in countries):
+                return False
+        if self.years:
+            return any(year['year'] in self.years for year in plan['usageYears'])
+        return True
+
+    def include_object(self, object):
+        if self.countryisos and 'iso3' in object and object['iso3'] not in self.countryisos:
+            return False
+        if self.years and 'year' in object and str(object['year']) not in self.years:
+            return False
+        return True
+
+    def download(self, partial_url=None, data=True, use_v2=False, url=None, select=None):
+        '''Download from FTS returning the data or if data is False the whole response. If select is given, only the
+        parts of the returned json that it specifies are kept (see select_json). This is ignored when outputting test
+        data or recording an archive so that responses are complete.'''
+        requested_url = url
+        endpoint = get_endpoint_family(partial_url or url)
+        if use_v2 or (url and url.startswith(self.v2_url) and not url.startswith(self.v1_url)):
+            version = 'v2'
+        else:
+            version = 'v1'
         if self.testpath:
             partial_url = self.get_testfile_path(partial_url, url)
         if partial_url is not None:
             url = self.get_url(partial_url, use_v2=use_v2)
-        r = self.downloader.download(url)
-        origjson = r.json()
+        # latency is the time taken by the request to FTS or reading the checkpoint or cache, wait the time before
+        # the request spent on the rate limiter and waiting for a downloader and processing the time after it spent
+        # parsing and storing the response
+        start = time.perf_counter()
+        wait = 0.0
+        content = None
+        checkpointed = False
+        if self.checkpoint:
+            content = self.checkpoint.get(url)
+            checkpointed = content is not None
+        if content is None and self.cache:
+            content = self.cache.get(url)
+        cached = content is not None
+        if content is None:
+            waitstart = time.perf_counter()
+            # downloaders are only taken once the rate limiter lets a request be made so there are no more of them
+            # than requests that can be made at once
+            if self.rate_limiter is not None:
+                self.rate_limiter()
+            with self.get_downloader() as downloader:
+                requeststart = time.perf_counter()
+                content = downloader.download(url).content
+                end = time.perf_counter()
+            wait = requeststart - waitstart
+            latency = end - requeststart
+            origjson = loads(content)
+            if self.cache and origjson['status'] == 'ok':
+                self.cache.set(url, content)
+        else:
+            end = time.perf_counter()
+            latency = end - start
+            origjson = loads(content)
+        if self.checkpoint and not checkpointed and origjson['status'] == 'ok':
+            self.checkpoint.set(url, content)
+        processing = time.perf_counter() - end
+        meta = origjson.get('meta')
+        if meta:
+            nextlink = meta.get('nextLink')
+        else:
+            nextlink = None
+        self.stats.record(requested_url, endpoint, version, latency, len(content), wait, processing, cached, nextlink)
         status = origjson['status']
         if status != 'ok':
             raise FTSException(f'{url} gives status {status}')
@@ -69,54 +347,50 @@ class FTSDownload:
                     pass
                 plans = json.get('plans')
                 if plans is not None:
-                    for i, plan in reversed(list(enumerate(plans))):
-                        delete = False
-                        if self.countryisos:
-                            countries = plan['countries']
-                            if countries:
-                                delete = True
-                                for country in countries:
-                                    if country['iso3'] in self.countryisos:
-                                        delete = False
-                                        break
-                        if not delete and self.years:
-                            delete = True
-                            for year in plan['usageYears']:
-                                if year['year'] in self.years:
-                                    delete = False
-                                    break
-                        if delete:
-                            del plans[i]
+                    if self.countryisos or self.years:
+                        plans = [plan for plan in plans if self.include_plan(plan)]
+                        json['plans'] = plans
                     if len(plans) == 0:
                         save = False
             elif self.countryisos or self.years:
-                for i, object in reversed(list(enumerate(json))):
-                    if 'iso3' in object:
-                        countryiso = object['iso3']
-                        if countryiso is None or countryiso not in self.countryisos:
-                            del json[i]
-                            continue
-                    if 'year' in object:
-                        year = str(object['year'])
-                        if year is None or year not in self.years:
-                            del json[i]
+                json = [object for object in json if self.include_object(object)]
+                origjson['data'] = json
         else:
             json = origjson
-        if save and self.testfolder and json:
+        if select is not None and not self.testfolder and not self.archive:
+            json = select_json(json, select)
+        # every response is archived so that the run can be replayed but empty responses and plan overviews with no
+        # plans left are not output as test data
+        savetest = save and self.testfolder and json
+        if savetest or self.archive:
             filename = self.get_testfile_path(partial_url, url)
-            filepath = join(self.testfolder, filename)
-            meta = origjson.get('meta')
-            if meta:
-                nextlink = meta.get('nextLink')
-            else:
-                nextlink = None
             if nextlink:
                 nextname = self.get_testfile_path(None, nextlink)
                 meta['nextLink'] = f'{self.test_url}{nextname}'
-                save_json(origjson, filepath)
+            if savetest:
+                save_json(origjson, join(self.testfolder, filename))
+            if self.archive:
+                self.archive.add(url, filename, origjson)
+            if nextlink:
                 meta['nextLink'] = nextlink
-            else:
-                save_json(origjson, filepath)
         return json
 
+    async def download_async(self, executor, **kwargs):
+        '''Run download in executor. Requests only overlap each other if there is create_downloader to give each
+        its own downloader, otherwise they are made one at a time and only reading the cache and checkpoint and
+        parsing responses overlap them.'''
+        loop = asyncio.get_running_loop()
+        # executor threads do not inherit context so run in a copy of it to keep the country requests are for
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor, partial(context.run, partial(self.download, **kwargs)))
+
+    def download_many(self, requests):
+        '''Download concurrently, returning results in the same order as requests. Each request is a dictionary of
+        keyword arguments for download.'''
+        async def download_all():
+            with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+                return await asyncio.gather(*[self.download_async(executor, **kwargs) for kwargs in requests])
 
+        if not requests:
+            return list()
+        return asyncio.run(download_all())
@@ -0,0 +1,63 @@
+import json
+import logging
+from hashlib import sha256
+from os import replace
+from os.path import exists
+from threading import Lock
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class Fingerprints:
+    '''Per country fingerprints of the FTS data used to generate each dataset. A new fingerprint is only stored once
+    the country's dataset has been published so that a failed upload is retried on the next run.'''
+
+    def __init__(self, path, full=False):
+        self.path = path
+        self.full = full
+        if exists(path):
+            self.fingerprints = load_json(path)
+        else:
+            self.fingerprints = dict()
+        self.pending = dict()
+        self.lock = Lock()
+        self.unchanged = 0
+
+    @staticmethod
+    def add_to_hash(fingerprint, value):
+        fingerprint.update(json.dumps(value, sort_keys=True, default=str).encode('utf-8'))
+        fingerprint.update(b'\n')
+
+    @staticmethod
+    def hash_resources(resources):
+        '''Hash names and file contents of generated resources in the given order'''
+        fingerprint = sha256()
+        for resource in resources:
+            fingerprint.update(resource['name'].encode('utf-8'))
+            fingerprint.update(b'\n')
+            with open(resource.get_file_to_upload(), 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    fingerprint.update(chunk)
+            fingerprint.update(b'\n')
+        return fingerprint.hexdigest()
+
+    def is_unchanged(self, countryiso, fingerprint):
+        with self.lock:
+            if not self.full and self.fingerprints.get(countryiso) == fingerprint:
+                self.unchanged += 1
+                return True
+            self.pending[countryiso] = fingerprint
+            return False
+
+    def commit(self, countryiso):
+        with self.lock:
+            fingerprint = self.pending.pop(countryiso, None)
+            if fingerprint is None:
+                return
+            self.fingerprints[countryiso] = fingerprint
+            temppath = f'{self.path}.tmp'
+            save_json(self.fingerprints, temppath)
+            replace(temppath, self.path)
@@ -1,20 +1,91 @@
+import contextvars
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from operator import itemgetter
+from os import makedirs, rename
+from os.path import join, exists, dirname
+from shutil import rmtree
+from threading import Lock, get_ident
 
 from hdx.utilities.dictandlist import dict_of_lists_add
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
 from hdx.utilities.text import multiple_replace
 
-from fts.helpers import country_all_columns_to_keep, rename_columns, funding_hxl_names
+from fts.download import day
+from fts.helpers import country_all_columns_to_keep, rename_columns, funding_hxl_names, write_resource_from_iterator
+from fts.requeststats import RequestStats
+from fts.rowstore import ExternalSorter, RowFile
 
 logger = logging.getLogger(__name__)
 
 srcdestmap = {'sourceObjects': 'src', 'destinationObjects': 'dest'}
+# Parts of flow responses used by flatten_flow and in getting boundaries
+flow_keys = set(country_all_columns_to_keep).union(rename_columns, srcdestmap)
+flows_select = {'status': None, 'meta': None, 'data': {'flows': {key: None for key in sorted(flow_keys)}}}
+# Flow rows are tuples of values in the order of the funding columns which take much less memory than dictionaries
+flow_columns = list(funding_hxl_names.keys())
+flow_column_index = {column: i for i, column in enumerate(flow_columns)}
+object_key_replacements = {'OrganizationOrganization': 'Organization', 'Name': '', 'types': 'Types', 'code': 'Code'}
+# Column plans by (src/dest, object type, key)
+column_plans = dict()
+# Time to live in seconds of partitions of the year before the latest, whose flows are still being reported and
+# corrected, and of earlier years
+recent_partition_ttl = day
+partition_ttl = 30 * day
+
+
+def get_column_plan(shortened, objtype, key):
+    '''Get how values of a key of source or destination objects of a type are output as a tuple of rule, column name,
+    column index and for years, start column index. Rule is years (start and end), iso3s (sorted ISO3s of location
+    names), join (sorted comma separated) or single (the value or Multiple). Returns None if nothing is output. Plans
+    are worked out once and reused.'''
+    plankey = (shortened, objtype, key)
+    try:
+        return column_plans[plankey]
+    except KeyError:
+        pass
+    keyname = multiple_replace(f'{shortened}{objtype}{key.capitalize()}', object_key_replacements)
+    startindex = None
+    if 'UsageYear' in keyname:
+        rule = 'years'
+        startindex = flow_column_index.get(f'{keyname}Start')
+        keyname = f'{keyname}End'
+    elif any(x in keyname for x in ['Cluster', 'Location', 'OrganizationTypes']):
+        if keyname[-1] != 's':
+            keyname = f'{keyname}s'
+        if 'Location' in keyname:
+            rule = 'iso3s'
+        else:
+            rule = 'join'
+    else:
+        rule = 'single'
+    index = flow_column_index.get(keyname)
+    if index is None and startindex is None and rule != 'single':
+        # single values are still checked for multiples so that they are logged
+        column_plan = None
+    else:
+        column_plan = (rule, keyname, index, startindex)
+    column_plans[plankey] = column_plan
+    return column_plan
 
 
 class Flows:
-    def __init__(self, downloader, locations, planidcodemapping):
+    def __init__(self, downloader, locations, planidcodemapping, spill_rows=None, bulk=False, memory=None,
+                 parquet=False):
         self.downloader = downloader
         self.locations = locations
         self.planidcodemapping = planidcodemapping
+        self.spill_rows = spill_rows
+        self.memory = memory
+        self.parquet = parquet
+        # When only some countries are being run, querying them by location id downloads less than harvesting
+        # the flows of all locations
+        self.bulk = bulk and not downloader.countryisos
+        self.bulk_lock = Lock()
+        self.flows_by_locationid = None
 
     def flatten_objects(self, objs, shortened, newrow):
         objinfo_by_type = dict()
@@ -22,119 +93,311 @@ class Flows:
         destPlanId = None
         for obj in objs:
             objtype = obj['type']
-            objinfo = objinfo_by_type.get(objtype, dict())
-            for key in obj:
-                if objtype == 'Plan' and key == 'id':
-                    plan_id = obj[key]
-                    dict_of_lists_add(objinfo, key, plan_id)
+            objinfo = objinfo_by_type.get(objtype)
+            if objinfo is None:
+                objinfo = dict()
+                objinfo_by_type[objtype] = objinfo
+            for key, value in obj.items():
+                if key == 'id':
+                    if objtype != 'Plan':
+                        continue
+                    plan_id = value
                     if shortened == 'dest':
                         destPlanId = plan_id
-                if key not in ['type', 'behavior', 'id']:
-                    value = obj[key]
-                    if isinstance(value, list):
-                        for element in value:
-                            dict_of_lists_add(objinfo, key, element)
-                    else:
-                        dict_of_lists_add(objinfo, key, value)
-            objinfo_by_type[objtype] = objinfo
-        for objtype in objinfo_by_type:
-            prefix = '%s%s' % (shortened, objtype)
-            for key in objinfo_by_type[objtype]:
-                keyname = '%s%s' % (prefix, key.capitalize())
-                values = objinfo_by_type[objtype][key]
-                replacements = {'OrganizationOrganization': 'Organization', 'Name': '', 'types': 'Types',
-                                'code': 'Code'}
-                keyname = multiple_replace(keyname, replacements)
-                if 'UsageYear' in keyname:
+                elif key == 'type' or key == 'behavior':
+                    continue
+                islist = isinstance(value, list)
+                if islist and not value:
+                    continue
+                info = objinfo.get(key)
+                if info is None:
+                    column_plan = get_column_plan(shortened, objtype, key)
+                    if column_plan is None:
+                        continue
+                    info = (column_plan, list())
+                    objinfo[key] = info
+                if islist:
+                    info[1].extend(value)
+                else:
+                    info[1].append(value)
+        for objinfo in objinfo_by_type.values():
+            for (rule, keyname, index, startindex), values in objinfo.values():
+                if rule == 'years':
                     values = sorted(values)
-                    newrow['%sStart' % keyname] = values[0]
+                    if startindex is not None:
+                        newrow[startindex] = values[0]
                     outputstr = values[-1]
-                    keyname = '%sEnd' % keyname
-                elif any(x in keyname for x in ['Cluster', 'Location', 'OrganizationTypes']):
-                    if keyname[-1] != 's':
-                        keyname = '%ss' % keyname
-                    if 'Location' in keyname:
-                        iso3s = list()
-                        for country in values:
-                            iso3 = self.locations.get_countryiso_from_name(country)
-                            if iso3:
-                                iso3s.append(iso3)
-                        values = iso3s
+                elif rule == 'iso3s':
+                    iso3s = list()
+                    for country in values:
+                        iso3 = self.locations.get_countryiso_from_name(country)
+                        if iso3:
+                            iso3s.append(iso3)
+                    outputstr = ','.join(sorted(iso3s))
+                elif rule == 'join':
                     outputstr = ','.join(sorted(values))
+                elif len(values) > 1:
+                    outputstr = 'Multiple'
+                    logger.error(f'Multiple used instead of {values} for {keyname} in {plan_id} ({shortened})')
                 else:
-                    if len(values) > 1:
-                        outputstr = 'Multiple'
-                        logger.error(f'Multiple used instead of {values} for {keyname} in {plan_id} ({shortened})')
-                    else:
-                        outputstr = values[0]
-                if keyname in country_all_columns_to_keep:
-                    newrow[keyname] = outputstr
+                    outputstr = values[0]
+                if index is not None:
+                    newrow[index] = outputstr
         return destPlanId
 
-    def generate_resources(self, folder, dataset, latestyear, country):
-        fund_boundaries_info = dict()
-        fund_data = list()
+    @staticmethod
+    def get_location_ids(objs):
+        return {obj['id'] for obj in objs if obj['type'] == 'Location'}
+
+    @staticmethod
+    def get_boundary(flow, locationid, year):
+        '''Classify a flow relative to a location and year the way the FTS API does for locationid and year
+        queries. Returns boundary and onBoundary or None if the flow is not in the location and year.'''
+        sides = list()
+        for key in srcdestmap:
+            locationids = set()
+            years = set()
+            for obj in flow[key]:
+                if obj['type'] == 'Location':
+                    locationids.add(obj['id'])
+                elif obj['type'] == 'UsageYear':
+                    years.add(obj['name'])
+            inside = locationid in locationids and year in years
+            shared = len(locationids) > 1 or len(years) > 1
+            sides.append((inside, shared))
+        (src_inside, src_shared), (dest_inside, dest_shared) = sides
+        if dest_inside:
+            if src_inside:
+                boundary = 'internal'
+            else:
+                boundary = 'incoming'
+            shared = dest_shared
+        elif src_inside:
+            boundary = 'outgoing'
+            shared = src_shared
+        else:
+            return None
+        if shared:
+            return boundary, 'shared'
+        return boundary, 'single'
+
+    def harvest_flows(self, latestyear):
+        '''Download all flows for the year once and index them by source and destination location id. The requests are
+        counted for all countries rather than the one that happens to trigger the harvest.'''
+        with self.bulk_lock, RequestStats.country(None):
+            if self.flows_by_locationid is not None:
+                return
+            flows_by_locationid = dict()
+            funding_url = self.downloader.get_url(f'fts/flow?year={latestyear}')
+            while funding_url:
+                json = self.downloader.download(url=funding_url, data=False, select=flows_select)
+                funding_url = json['meta'].get('nextLink')
+                for flow in json['data']['flows']:
+                    locationids = self.get_location_ids(flow['sourceObjects'])
+                    locationids.update(self.get_location_ids(flow['destinationObjects']))
+                    for locationid in locationids:
+                        dict_of_lists_add(flows_by_locationid, locationid, flow)
+            for flows in flows_by_locationid.values():
+                # match the ordering of locationid queries so that rows with equal dates are written in the same order
+                flows.sort(key=lambda k: int(k['id']))
+            logger.info(f'Harvested flows for {latestyear} for {len(flows_by_locationid)} locations')
+            self.flows_by_locationid = flows_by_locationid
+
+    def get_bulk_flows(self, country, latestyear):
+        self.harvest_flows(latestyear)
+        locationid = str(country['id'])
+        flows = list()
+        for flow in self.flows_by_locationid.get(locationid, list()):
+            boundary = self.get_boundary(flow, locationid, latestyear)
+            if boundary is None:
+                continue
+            boundary, onBoundary = boundary
+            flows.append(dict(flow, boundary=boundary, onBoundary=onBoundary))
+        return flows
+
+    def get_flows(self, country, latestyear, bulk=True):
+        if self.bulk and bulk:
+            yield self.get_bulk_flows(country, latestyear)
+            return
         base_funding_url = f'fts/flow?locationid={country["id"]}&'
         funding_url = self.downloader.get_url(f'{base_funding_url}year={latestyear}')
         while funding_url:
-            json = self.downloader.download(url=funding_url, data=False)
-            fund_data.extend(json['data']['flows'])
+            json = self.downloader.download(url=funding_url, data=False, select=flows_select)
             funding_url = json['meta'].get('nextLink')
+            yield json['data']['flows']
 
-        for row in fund_data:
-            newrow = dict()
-            destPlanId = None
-            for key in row:
-                if key == 'reportDetails':
-                    continue
-                value = row[key]
-                shortened = srcdestmap.get(key)
-                if shortened:
-                    newdestPlanId = self.flatten_objects(value, shortened, newrow)
-                    if newdestPlanId:
-                        destPlanId = int(newdestPlanId)
-                    continue
-                if key == 'keywords':
-                    if value:
-                        newrow[key] = ','.join(value)
-                    else:
-                        newrow[key] = ''
-                    continue
-                if key in ['date', 'firstReportedDate', 'decisionDate', 'createdAt', 'updatedAt']:
-                    if value:
-                        newrow[key] = value[:10]
-                    else:
-                        newrow[key] = ''
-                    continue
-                renamed_column = rename_columns.get(key)
-                if renamed_column:
-                    newrow[renamed_column] = value
-                    continue
-                if key in country_all_columns_to_keep:
-                    newrow[key] = value
-            if 'originalAmount' not in newrow:
-                newrow['originalAmount'] = ''
-            if 'originalCurrency' not in newrow:
-                newrow['originalCurrency'] = ''
-            if 'refCode' not in newrow:
-                newrow['refCode'] = ''
-            newrow['destPlanCode'] = self.planidcodemapping.get(destPlanId, '')
-            boundary = row['boundary']
-            rows = fund_boundaries_info.get(boundary, list())
-            rows.append(newrow)
-            fund_boundaries_info[boundary] = rows
+    def flatten_flow(self, row):
+        '''Flatten a flow into a tuple of values in the order of flow_columns'''
+        newrow = [None] * len(flow_columns)
+        destPlanId = None
+        for key in row:
+            if key == 'reportDetails':
+                continue
+            value = row[key]
+            shortened = srcdestmap.get(key)
+            if shortened:
+                newdestPlanId = self.flatten_objects(value, shortened, newrow)
+                if newdestPlanId:
+                    destPlanId = int(newdestPlanId)
+                continue
+            if key == 'keywords':
+                if value:
+                    newrow[flow_column_index[key]] = ','.join(value)
+                else:
+                    newrow[flow_column_index[key]] = ''
+                continue
+            if key in ['date', 'firstReportedDate', 'decisionDate', 'createdAt', 'updatedAt']:
+                if value:
+                    newrow[flow_column_index[key]] = value[:10]
+                else:
+                    newrow[flow_column_index[key]] = ''
+                continue
+            renamed_column = rename_columns.get(key)
+            if renamed_column:
+                index = flow_column_index.get(renamed_column)
+                if index is not None:
+                    newrow[index] = value
+                continue
+            index = flow_column_index.get(key)
+            if index is not None:
+                newrow[index] = value
+        newrow[flow_column_index['destPlanCode']] = self.planidcodemapping.get(destPlanId, '')
+        return tuple(newrow)
+
+    def collect_rows(self, folder, country, latestyear, fingerprint=None, bulk=True):
+        # Flows are flattened a page at a time. If spill_rows is set or memory goes over budget, sorted runs of rows
+        # are spilled to disk and merged when writing so that memory use does not depend on the number of flows.
+        fund_boundaries_info = dict()
+        collected = False
+        try:
+            for flows in self.get_flows(country, latestyear, bulk=bulk):
+                for row in flows:
+                    if fingerprint is not None:
+                        fingerprint.update(f'{row["id"]}:{row.get("updatedAt")}\n'.encode('utf-8'))
+                    boundary = row['boundary']
+                    rows = fund_boundaries_info.get(boundary)
+                    if rows is None:
+                        rows = ExternalSorter(key=itemgetter(flow_column_index['date']), reverse=True,
+                                              max_rows=self.spill_rows, folder=folder, memory=self.memory)
+                        fund_boundaries_info[boundary] = rows
+                    rows.append(self.flatten_flow(row))
+            collected = True
+        finally:
+            if not collected:
+                self.close_rows(fund_boundaries_info)
+        return fund_boundaries_info
+
+    @staticmethod
+    def save_partition(fund_boundaries_info, partitionfolder, digest):
+        # write to a temporary folder and rename it so that a partition is only ever seen complete
+        tempfolder = f'{partitionfolder}.{get_ident()}.tmp'
+        makedirs(tempfolder)
+        for boundary, rows in fund_boundaries_info.items():
+            rows.save(join(tempfolder, f'{boundary}.jsonl'))
+            rows.close()
+        save_json({'boundaries': sorted(fund_boundaries_info), 'digest': digest, 'created': time.time()},
+                  join(tempfolder, 'partition.json'))
+        if exists(partitionfolder):
+            # move an expired partition aside rather than deleting it first so there is always a complete one
+            oldfolder = f'{partitionfolder}.{get_ident()}.old'
+            rename(partitionfolder, oldfolder)
+            rmtree(oldfolder)
+        try:
+            rename(tempfolder, partitionfolder)
+        except OSError:
+            rmtree(tempfolder)
+            if not exists(join(partitionfolder, 'partition.json')):
+                raise
 
+    @staticmethod
+    def load_partition(partitionfolder):
+        info = load_json(join(partitionfolder, 'partition.json'))
+        fund_boundaries_info = {boundary: RowFile(join(partitionfolder, f'{boundary}.jsonl'))
+                                for boundary in info['boundaries']}
+        return fund_boundaries_info, info['digest']
+
+    @staticmethod
+    def is_partition_current(partitionfolder, year, latestyear):
+        path = join(partitionfolder, 'partition.json')
+        if not exists(path):
+            return False
+        if int(year) >= int(latestyear) - 1:
+            ttl = recent_partition_ttl
+        else:
+            ttl = partition_ttl
+        # partitions made before they had a creation time have expired
+        return time.time() - load_json(path).get('created', 0) <= ttl
+
+    def get_past_year_rows(self, folder, partitions_folder, country, year, latestyear):
+        '''Get the rows of a past year from its partition, downloading the year's flows and saving them as a
+        partition if an earlier run has not already done so or its partition has expired. Flows of the year before
+        the latest are still being reported and corrected so its partition expires after recent_partition_ttl and
+        those of earlier years after partition_ttl. Returns rows by boundary and a digest of the flows.'''
+        partitionfolder = join(partitions_folder, country['iso3'], year)
+        if not self.is_partition_current(partitionfolder, year, latestyear):
+            fingerprint = sha256(year.encode('utf-8'))
+            fund_boundaries_info = self.collect_rows(folder, country, year, fingerprint, bulk=False)
+            makedirs(dirname(partitionfolder), exist_ok=True)
+            self.save_partition(fund_boundaries_info, partitionfolder, fingerprint.hexdigest())
+        return self.load_partition(partitionfolder)
+
+    def collect_years(self, folder, partitions_folder, country, latestyear, pastyears, fingerprint=None):
+        '''Collect rows by boundary for the latest year and past years. Each year's flows are downloaded as their own
+        partition concurrently with the other years within the downloader's rate limit. Past years are reused from
+        partitions_folder until their partitions expire (see get_past_year_rows). The fingerprint is updated with
+        past years in order so it does not depend on which finishes first. If any year fails, the rows of the others
+        are closed.'''
+        rows_by_year = dict()
+        futures = list()
+        collected = False
+        try:
+            with ThreadPoolExecutor(max_workers=self.downloader.max_concurrent) as executor:
+                # each task runs in its own copy of the context so that requests are counted for the country
+                futures = [executor.submit(contextvars.copy_context().run, self.get_past_year_rows, folder,
+                                           partitions_folder, country, year, latestyear) for year in pastyears]
+                rows_by_year[latestyear] = self.collect_rows(folder, country, latestyear, fingerprint)
+                for year, future in zip(pastyears, futures):
+                    rows_by_year[year], digest = future.result()
+                    if fingerprint is not None:
+                        fingerprint.update(f'{year}:{digest}\n'.encode('utf-8'))
+            collected = True
+        finally:
+            if not collected:
+                # the executor has waited for the other years so all of their rows can be closed
+                for fund_boundaries_info in rows_by_year.values():
+                    self.close_rows(fund_boundaries_info)
+                for future in futures:
+                    if not future.cancelled() and future.exception() is None:
+                        self.close_rows(future.result()[0])
+        return rows_by_year
+
+    @staticmethod
+    def close_rows(fund_boundaries_info):
+        for rows in fund_boundaries_info.values():
+            rows.close()
+
+    def write_resources(self, fund_boundaries_info, folder, dataset, latestyear, country, suffix=''):
         resources = list()
-        for boundary in sorted(fund_boundaries_info.keys()):
-            rows = sorted(fund_boundaries_info[boundary], key=lambda k: k['date'], reverse=True)
-            headers = list(funding_hxl_names.keys())
-            filename = f'fts_{boundary}_funding_{country["iso3"].lower()}.csv'
-            resourcedata = {
-                'name': filename,
-                'description': f'FTS {boundary.capitalize()} Funding Data for {country["name"]} for {latestyear}',
-                'format': 'csv'
-            }
-            success, results = dataset.generate_resource_from_iterator(headers, rows, funding_hxl_names, folder, filename, resourcedata)
-            if success:
-                resources.append(results['resource'])
-        return resources
\ No newline at end of file
+        try:
+            for boundary in sorted(fund_boundaries_info.keys()):
+                rows = fund_boundaries_info[boundary]
+                headers = flow_columns
+                filename = f'fts_{boundary}_funding_{country["iso3"].lower()}{suffix}.csv'
+                resourcedata = {
+                    'name': filename,
+                    'description': f'FTS {boundary.capitalize()} Funding Data for {country["name"]} for {latestyear}',
+                    'format': 'csv'
+                }
+                success, results = write_resource_from_iterator(dataset, headers, rows, funding_hxl_names, folder,
+                                                                filename, resourcedata, parquet=self.parquet)
+                rows.close()
+                if success:
+                    resources.append(results['resource'])
+        finally:
+            # remove any runs spilled to disk even if writing fails
+            self.close_rows(fund_boundaries_info)
+        return resources
+
+    def generate_resources(self, folder, dataset, latestyear, country):
+        fund_boundaries_info = self.collect_rows(folder, country, latestyear)
+        return self.write_resources(fund_boundaries_info, folder, dataset, latestyear, country)
@@ -1,5 +1,21 @@
+import csv
+import logging
+from datetime import date
+from os import remove
+from os.path import join, splitext
+
 from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
 from hdx.data.showcase import Showcase
+from hdx.utilities.downloader import Download
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
 
 funding_hxl_names = {
     'date': '#date',
@@ -70,6 +86,30 @@ country_all_columns_to_keep = ['date', 'budgetYear', 'description', 'amountUSD',
                                'contributionType', 'flowType', 'method', 'boundary', 'onBoundary', 'status',
                                'firstReportedDate', 'decisionDate', 'keywords', 'originalAmount', 'originalCurrency',
                                'exchangeRate', 'id', 'refCode', 'createdAt', 'updatedAt']
+# Types of columns in Parquet output. Other columns are strings.
+parquet_types = {
+    'date': 'date',
+    'budgetYear': 'int',
+    'amountUSD': 'float',
+    'srcUsageYearStart': 'int',
+    'srcUsageYearEnd': 'int',
+    'destUsageYearStart': 'int',
+    'destUsageYearEnd': 'int',
+    'firstReportedDate': 'date',
+    'decisionDate': 'date',
+    'originalAmount': 'float',
+    'exchangeRate': 'float',
+    'createdAt': 'date',
+    'updatedAt': 'date',
+    'startDate': 'date',
+    'endDate': 'date',
+    'year': 'int',
+    'requirements': 'float',
+    'funding': 'float',
+    'percentFunded': 'int',
+}
+# Parts of groupby responses used in generating requirements and funding
+groupby_select = {'requirements': None, 'report3': {'fundingTotals': None}}
 country_emergency_columns_to_keep = ['id', 'name', 'code', 'startDate', 'endDate', 'year', 'revisedRequirements',
                                      'totalFunding', 'percentFunded']
 plan_columns_to_keep = ['clusterCode', 'clusterName', 'revisedRequirements', 'totalFunding']
@@ -99,4 +139,124 @@ def get_dataset_and_showcase(slugified_name, title, description, today, country,
         'image_url': 'https://fts.unocha.org/sites/default/files/styles/fts_feature_image/public/navigation_101.jpg'
     })
     showcase.add_tags(tags)
-    return dataset, showcase
\ No newline at end of file
+    return dataset, showcase
+
+
+def check_parquet():
+    if pyarrow is None:
+        raise ImportError('Parquet output needs pyarrow to be installed!')
+
+
+def to_parquet_value(value, parquet_type):
+    '''Convert value to parquet_type raising ValueError if it cannot be converted without losing part of it'''
+    if value is None or value == '':
+        return None
+    try:
+        if parquet_type == 'date':
+            return date.fromisoformat(value[:10])
+        if parquet_type == 'int':
+            if isinstance(value, int):
+                return value
+            number = float(value)
+            if not number.is_integer():
+                raise ValueError('not a whole number')
+            return int(number)
+        if parquet_type == 'float':
+            return float(value)
+    except (TypeError, ValueError) as ex:
+        raise ValueError(f'Cannot convert {value!r} to {parquet_type}: {ex}') from ex
+    return str(value)
+
+
+class ParquetRows:
+    '''Writes rows to a Parquet file in row groups of row_group_rows rows with the types in parquet_types and the HXL
+    tag of each column in its metadata. A value that cannot be converted to the type of its column is logged as an
+    error and written as null.'''
+
+    def __init__(self, path, headers, hxltags, row_group_rows=10000):
+        check_parquet()
+        pyarrow_types = {'date': pyarrow.date32(), 'int': pyarrow.int64(), 'float': pyarrow.float64()}
+        self.types = [parquet_types.get(header) for header in headers]
+        fields = list()
+        for header, parquet_type in zip(headers, self.types):
+            hxltag = hxltags.get(header)
+            fields.append(pyarrow.field(header, pyarrow_types.get(parquet_type, pyarrow.string()),
+                                        metadata=None if hxltag is None else {'hxl': hxltag}))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.path = path
+        self.headers = headers
+        self.row_group_rows = row_group_rows
+        self.columns = [list() for _ in headers]
+
+    def append(self, row):
+        for header, column, parquet_type, value in zip(self.headers, self.columns, self.types, row):
+            try:
+                value = to_parquet_value(value, parquet_type)
+            except ValueError as ex:
+                logger.error(f'{header} in {self.path}: {ex}! Writing null.')
+                value = None
+            column.append(value)
+        if len(self.columns[0]) >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field
+                                                           in zip(self.columns, self.schema)], schema=self.schema))
+        self.columns = [list() for _ in self.columns]
+
+    def close(self):
+        if self.columns[0]:
+            self.flush()
+        self.writer.close()
+
+
+def write_resource_from_iterator(dataset, headers, iterator, hxltags, folder, filename, resourcedata, parquet=False):
+    '''Write rows to csv with a HXL row and create resource, adding it to the dataset. Rows are either mappings or
+    tuples or lists of values in the order of headers. Unlike Dataset.generate_resource_from_iterator, rows are
+    written as they are iterated rather than being collected in a list first so memory use does not grow with the
+    number of rows. If parquet is True, the rows are also written to a Parquet file of the same name (see ParquetRows)
+    which is added to the dataset as another resource. The Parquet file is removed if there are no rows or writing
+    fails.'''
+    filepath = join(folder, filename)
+    parquetname = f'{splitext(filename)[0]}.parquet'
+    parquetpath = join(folder, parquetname)
+    if parquet:
+        parquetrows = ParquetRows(parquetpath, headers, hxltags)
+    else:
+        parquetrows = None
+    count = 0
+    written = False
+    try:
+        with open(filepath, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(headers)
+            writer.writerow(Download.hxl_row(headers, hxltags))
+            for row in iterator:
+                if not isinstance(row, (tuple, list)):
+                    row = [row.get(header) for header in headers]
+                writer.writerow(row)
+                if parquetrows is not None:
+                    parquetrows.append(row)
+                count += 1
+        written = True
+    finally:
+        if parquetrows is not None:
+            parquetrows.close()
+            if not written or count == 0:
+                remove(parquetpath)
+    if count == 0:
+        return False, dict()
+    resource = Resource(resourcedata)
+    resource.set_file_type('csv')
+    resource.set_file_to_upload(filepath)
+    dataset.add_update_resource(resource)
+    results = {'resource': resource, 'headers': headers}
+    if parquetrows is not None:
+        parquetresource = Resource({'name': parquetname, 'description': f'{resourcedata["description"]} (Parquet)',
+                                    'format': 'parquet'})
+        parquetresource.set_file_type('parquet')
+        parquetresource.set_file_to_upload(parquetpath)
+        dataset.add_update_resource(parquetresource)
+        results['parquet_resource'] = parquetresource
+    return True, results
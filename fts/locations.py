@@ -1,27 +1,102 @@
+import json
+import logging
+import time
+from hashlib import sha256
+from os import replace
+from os.path import exists
+
 from hdx.location.country import Country
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+snapshot_version = 1
+snapshot_ttl = 7 * 24 * 60 * 60
 
 
 class Locations:
-    def __init__(self, downloader):
+    '''FTS locations and the countries among them known to HDX. If snapshot_path is given, they are loaded from a
+    snapshot there made by an earlier run unless it is older than snapshot_ttl seconds or does not validate, in which
+    case they are downloaded and the snapshot is made again.'''
+
+    def __init__(self, downloader, snapshot_path=None, snapshot_ttl=snapshot_ttl):
         self.name_to_iso3 = dict()
         self.name_to_id = dict()
         self.id_to_iso3 = dict()
+        url = downloader.get_url('location')
+        # the location response must be requested to be output as test data or recorded
+        if downloader.testfolder or downloader.archive:
+            snapshot_path = None
+        snapshot = self.load_snapshot(snapshot_path, url, snapshot_ttl)
+        if snapshot is None:
+            locations, countryisos = self.download_locations(downloader)
+            # a snapshot must have every location
+            if snapshot_path and not downloader.countryisos:
+                self.save_snapshot(snapshot_path, url, locations, countryisos)
+        else:
+            locations, countryisos = snapshot
+            locations = [location for location in locations if downloader.include_object({'iso3': location[1]})]
         countries = set()
-        for country in downloader.download('location'):
-            countryiso = country['iso3']
-            if countryiso is None:
-                continue
-            countryid = country['id']
-            countryname = country['name']
+        for countryname, countryiso, countryid in locations:
             self.name_to_iso3[countryname] = countryiso
             self.name_to_id[countryname] = countryid
             self.id_to_iso3[countryid] = countryiso
-            hdxcountryname = Country.get_country_name_from_iso3(countryiso)
-            if hdxcountryname is None:
-                continue
-            countries.add((countryname, countryiso, countryid))
+            if countryiso in countryisos:
+                countries.add((countryname, countryiso, countryid))
         self.countries = [{'id': country[2], 'iso3': country[1], 'name': country[0]} for country in sorted(countries)]
 
+    @staticmethod
+    def download_locations(downloader):
+        '''Download (name, iso3, id) of locations with an iso3 and the set of those iso3s that HDX knows'''
+        locations = list()
+        countryisos = set()
+        for country in downloader.download('location'):
+            countryiso = country['iso3']
+            if countryiso is None:
+                continue
+            locations.append((country['name'], countryiso, country['id']))
+            if Country.get_country_name_from_iso3(countryiso) is not None:
+                countryisos.add(countryiso)
+        return locations, countryisos
+
+    @staticmethod
+    def get_checksum(url, locations, countryisos):
+        return sha256(json.dumps([url, locations, countryisos]).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load_snapshot(cls, path, url, ttl):
+        if path is None or not exists(path):
+            return None
+        try:
+            snapshot = load_json(path)
+            if snapshot['version'] != snapshot_version or snapshot['url'] != url:
+                return None
+            if time.time() - snapshot['created'] > ttl:
+                logger.info('Locations snapshot has expired')
+                return None
+            locations = [tuple(location) for location in snapshot['locations']]
+            countryisos = snapshot['countryisos']
+            if snapshot['checksum'] != cls.get_checksum(url, snapshot['locations'], countryisos):
+                raise ValueError('checksum does not match')
+            # every country must be a location
+            if not set(countryisos) <= {location[1] for location in locations}:
+                raise ValueError('countries are not all locations')
+        except (ValueError, KeyError, TypeError, IndexError) as ex:
+            logger.warning(f'Ignoring invalid locations snapshot {path}: {ex}')
+            return None
+        return locations, set(countryisos)
+
+    @classmethod
+    def save_snapshot(cls, path, url, locations, countryisos):
+        locations = [list(location) for location in locations]
+        countryisos = sorted(countryisos)
+        snapshot = {'version': snapshot_version, 'url': url, 'created': time.time(), 'locations': locations,
+                    'countryisos': countryisos, 'checksum': cls.get_checksum(url, locations, countryisos)}
+        temppath = f'{path}.tmp'
+        save_json(snapshot, temppath)
+        replace(temppath, path)
+
     def get_countryid_from_object(self, object):
         countryid = object.get('id')
         if countryid is None:
@@ -31,4 +106,4 @@ class Locations:
         return countryid
 
     def get_countryiso_from_name(self, name):
-        return self.name_to_iso3.get(name)
\ No newline at end of file
+        return self.name_to_iso3.get(name)
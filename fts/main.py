@@ -8,51 +8,89 @@ Generates FTS datasets.
 
 '''
 import logging
+from contextlib import nullcontext
+from functools import partial
+from hashlib import sha256
+from os.path import splitext
 
 from hdx.data.hdxobject import HDXError
 from hdx.utilities.dictandlist import dict_of_lists_add
 from slugify import slugify
 
 from fts.flows import Flows
-from fts.helpers import get_dataset_and_showcase
+from fts.helpers import get_dataset_and_showcase, check_parquet
+from fts.planresults import PlanResults
 from fts.requirements_funding import RequirementsFunding
 from fts.requirements_funding_covid import RequirementsFundingCovid
 from fts.requirements_funding_cluster import RequirementsFundingCluster
+from fts.rowstore import RowSpool
 
 logger = logging.getLogger(__name__)
 
+# Stands in for a country in the names and descriptions of the global resources
+allcountries = {'iso3': 'all', 'name': 'all countries'}
+
 
 class FTS:
-    def __init__(self, downloader, locations, today, notes, start_year=1998):
+    def __init__(self, downloader, locations, today, notes, start_year=1998, flow_spill_rows=None, bulk_flows=False,
+                 fingerprints=None, flow_years=1, partitions_folder=None, covid_funding_path=None, memory=None,
+                 parquet=False):
         self.downloader = downloader
         self.locations = locations
         self.today = today
         self.notes = notes
+        self.fingerprints = fingerprints
+        # past years for which flows are exported as well as the latest year
+        self.pastflowyears = [str(today.year - i) for i in range(1, flow_years)]
+        self.partitions_folder = partitions_folder
+        self.covid_funding_path = covid_funding_path
+        self.memory = memory
+        if parquet:
+            check_parquet()
+        self.parquet = parquet
         self.plans_by_year_by_country = dict()
         self.planidcodemapping = dict()
         self.planidswithonelocation = set()
         self.globalplanids = set()
-        self.reqfund = RequirementsFunding(downloader, locations, self.globalplanids, today)
-        self.get_plans(start_year=start_year)
-        self.flows = Flows(downloader, locations, self.planidcodemapping)
-        self.others = self.setup_others(downloader, locations)
+        self.planresults = PlanResults()
+        self.reqfund = RequirementsFunding(downloader, locations, self.globalplanids, today, parquet=parquet)
+        with self.memory_stage('plans'):
+            self.get_plans(start_year=start_year)
+        self.flows = Flows(downloader, locations, self.planidcodemapping, spill_rows=flow_spill_rows,
+                           bulk=bulk_flows, memory=memory, parquet=parquet)
+        with self.memory_stage('covid_funding'):
+            self.others = self.setup_others(downloader, locations)
+
+    def memory_stage(self, name):
+        if self.memory is None:
+            return nullcontext()
+        return self.memory.stage(name)
 
     def setup_others(self, downloader, locations):
-        covid = RequirementsFundingCovid(downloader, self.plans_by_year_by_country)
-        cluster = RequirementsFundingCluster(downloader, locations, self.planidswithonelocation)
-        globalcluster = RequirementsFundingCluster(downloader, locations, self.planidswithonelocation, clusterlevel='global')
+        covid = RequirementsFundingCovid(downloader, self.plans_by_year_by_country, self.planresults,
+                                         currentyear=self.today.year, known_path=self.covid_funding_path,
+                                         parquet=self.parquet)
+        cluster = RequirementsFundingCluster(downloader, locations, self.planidswithonelocation, self.planresults,
+                                             parquet=self.parquet)
+        globalcluster = RequirementsFundingCluster(downloader, locations, self.planidswithonelocation,
+                                                   self.planresults, clusterlevel='global', parquet=self.parquet)
         return {'covid': covid, 'cluster': cluster, 'globalcluster': globalcluster}
 
     def get_plans(self, start_year=1998):
-        for year in range(self.today.year, start_year, -1):
-            data = self.downloader.download(f'fts/flow/plan/overview/progress/{year}', use_v2=True)
-            plans = data['plans']
-            for plan in plans:
+        years = list(range(self.today.year, start_year, -1))
+        datas = self.downloader.download_many([{'partial_url': f'fts/flow/plan/overview/progress/{year}',
+                                                'use_v2': True} for year in years])
+        plans_by_year = {year: data['plans'] for year, data in zip(years, datas)}
+        location_funding = self.reqfund.download_location_funding(plan for year in years
+                                                                  for plan in plans_by_year[year])
+        for year in years:
+            for plan in plans_by_year[year]:
                 planid = plan['id']
                 self.planidcodemapping[planid] = plan['code']
                 countries = plan['countries']
                 if countries:
-                    is_global = self.reqfund.add_country_requirements_funding(planid, plan, countries)
+                    is_global = self.reqfund.add_country_requirements_funding(year, planid, plan, countries,
+                                                                              location_funding.get(planid))
                     if is_global:
                         self.globalplanids.add(planid)
                     if len(countries) == 1:
@@ -61,28 +99,68 @@ class FTS:
                         countryiso = country['iso3']
                         if not countryiso:
                             continue
-                        plans_by_year = self.plans_by_year_by_country.get(countryiso, {})
-                        dict_of_lists_add(plans_by_year, year, plan)
-                        self.plans_by_year_by_country[countryiso] = plans_by_year
+                        plans_by_year_for_country = self.plans_by_year_by_country.get(countryiso, {})
+                        dict_of_lists_add(plans_by_year_for_country, year, plan)
+                        self.plans_by_year_by_country[countryiso] = plans_by_year_for_country
 
-    def call_others(self, row):
+    def call_others(self, others_rows, row):
         requirements_clusters, funding_clusters, notspecified, shared = self.others['cluster'].get_requirements_funding_plan(row)
-        self.others['cluster'].generate_rows_requirements_funding(row, requirements_clusters, funding_clusters, notspecified, shared)
-        self.others['covid'].generate_plan_requirements_funding(row, requirements_clusters)
-        self.others['globalcluster'].generate_plan_requirements_funding(row)
+        self.others['cluster'].generate_rows_requirements_funding(others_rows['cluster'], row, requirements_clusters, funding_clusters, notspecified, shared)
+        self.others['covid'].generate_plan_requirements_funding(others_rows['covid'], row, requirements_clusters)
+        self.others['globalcluster'].generate_plan_requirements_funding(others_rows['globalcluster'], row)
 
-    def generate_other_resources(self, resources, folder, dataset, country):
-        resource = self.others['globalcluster'].generate_resource(folder, dataset, country)
+    def generate_other_resources(self, others_rows, resources, folder, dataset, country):
+        resource = self.others['globalcluster'].generate_resource(others_rows['globalcluster'], folder, dataset, country)
         if resource:
             resources.insert(1, resource)
-        hxlresource = self.others['cluster'].generate_resource(folder, dataset, country)
+        hxlresource = self.others['cluster'].generate_resource(others_rows['cluster'], folder, dataset, country)
         if hxlresource:
             resources.insert(1, hxlresource)
-        resource = self.others['covid'].generate_resource(folder, dataset, country)
+        resource = self.others['covid'].generate_resource(others_rows['covid'], folder, dataset, country)
         if resource:
             resources.insert(1, resource)
         return hxlresource
 
+    def get_ordered_resource_names(self, dataset, resources):
+        '''Names of resources in order, each followed by its Parquet resource if there is one'''
+        ordered_resource_names = list()
+        names = {x['name'] for x in dataset.get_resources()}
+        for resource in resources:
+            name = resource['name']
+            ordered_resource_names.append(name)
+            parquetname = f'{splitext(name)[0]}.parquet'
+            if self.parquet and parquetname in names:
+                ordered_resource_names.append(parquetname)
+        return ordered_resource_names
+
+    def add_plans_to_fingerprint(self, fingerprint, country):
+        '''Add the plans of a country to its fingerprint along with the rest of the FTS data that its requirements
+        and funding, cluster and COVID resources are generated from: the country's funding by year, the cluster and
+        global cluster breakdowns and COVID components of its plans and their COVID funding. These are all kept
+        once got so generating the resources does not download them again.'''
+        plans_by_year = self.plans_by_year_by_country.get(country['iso3'])
+        if not plans_by_year:
+            return
+        for year in sorted(plans_by_year):
+            for plan in plans_by_year[year]:
+                planid = plan['id']
+                country_requirements_funding = [self.reqfund.get_country_requirements_funding(year, planid,
+                                                                                              plancountry['id'])
+                                                for plancountry in plan['countries']]
+                self.fingerprints.add_to_hash(fingerprint, [year, planid, plan.get('updatedAt'),
+                                                            plan.get('requirements'), plan.get('funding'),
+                                                            country_requirements_funding])
+                if planid in self.globalplanids:
+                    continue
+                row = {'id': planid}
+                self.fingerprints.add_to_hash(fingerprint, [
+                    self.others['cluster'].get_requirements_funding_plan(row),
+                    self.others['globalcluster'].get_requirements_funding_plan(row),
+                    sorted(self.others['covid'].get_covid_ids(planid)),
+                    self.others['covid'].covidfundingbyplan.get(planid)])
+        funding_by_year = self.reqfund.get_funding_by_year(plans_by_year, country)
+        self.fingerprints.add_to_hash(fingerprint, sorted(funding_by_year.items()))
+
     def generate_dataset_and_showcase(self, folder, country):
         '''
         api.hpc.tools/v1/public/fts/flow?countryISO3=CMR&Year=2016&groupby=cluster
@@ -107,7 +185,38 @@ class FTS:
         except HDXError as e:
             logger.error(f'{title} has a problem! {e}')
             return None, None, None, None
-        resources = self.flows.generate_resources(folder, dataset, latestyear, country)
+        if self.fingerprints is None:
+            fingerprint = None
+        else:
+            fingerprint = sha256(latestyear.encode('utf-8'))
+        with self.memory_stage('flows'):
+            if self.pastflowyears:
+                rows_by_year = self.flows.collect_years(folder, self.partitions_folder, country, latestyear,
+                                                        self.pastflowyears, fingerprint)
+            else:
+                rows_by_year = {latestyear: self.flows.collect_rows(folder, country, latestyear, fingerprint)}
+        if fingerprint is not None:
+            with self.memory_stage('fingerprint'):
+                self.add_plans_to_fingerprint(fingerprint, country)
+            if self.fingerprints.is_unchanged(countryiso, fingerprint.hexdigest()):
+                logger.info(f'FTS data for {countryname} is unchanged since last run')
+                for fund_boundaries_info in rows_by_year.values():
+                    self.flows.close_rows(fund_boundaries_info)
+                return None, None, None, None
+        resources = list()
+        with self.memory_stage('flow_resources'):
+            try:
+                for year, fund_boundaries_info in rows_by_year.items():
+                    if year == latestyear:
+                        suffix = ''
+                    else:
+                        suffix = f'_{year}'
+                    resources.extend(self.flows.write_resources(fund_boundaries_info, folder, dataset, year, country,
+                                                                suffix))
+            finally:
+                # years after one whose writing fails are never written
+                for fund_boundaries_info in rows_by_year.values():
+                    self.flows.close_rows(fund_boundaries_info)
         if len(resources) == 0:
             logger.warning('No requirements or funding data available')
             return None, None, None, None
@@ -117,10 +226,60 @@ class FTS:
         if plans_by_year is None:
             logger.error(f'We have latest year funding data but no overall funding data for {title}')
         else:
-            hxl_resource = self.reqfund.generate_resource(folder, dataset, plans_by_year, country, self.call_others)
-            resources.insert(0, hxl_resource)
-            other_hxl_resource = self.generate_other_resources(resources, folder, dataset, country)
+            # Rows for the other resources are kept per country so that countries can be generated concurrently
+            others_rows = {key: RowSpool(folder, self.memory) for key in self.others}
+            try:
+                with self.memory_stage('requirements_funding'):
+                    hxl_resource = self.reqfund.generate_resource(folder, dataset, plans_by_year, country,
+                                                                  partial(self.call_others, others_rows))
+                resources.insert(0, hxl_resource)
+                with self.memory_stage('other_resources'):
+                    other_hxl_resource = self.generate_other_resources(others_rows, resources, folder, dataset,
+                                                                       country)
+            finally:
+                for rows in others_rows.values():
+                    rows.close()
             if other_hxl_resource:
                 hxl_resource = other_hxl_resource
-        ordered_resource_names = [x['name'] for x in resources]
+        ordered_resource_names = self.get_ordered_resource_names(dataset, resources)
+        return dataset, showcase, hxl_resource, ordered_resource_names
+
+    def generate_global_dataset(self, folder, countries):
+        '''Generate a dataset combining the requirements and funding, cluster and COVID resources of the given
+        countries in one pass over the plans already loaded. Country funding and per plan results from generating the
+        country datasets are reused.'''
+        logger.info('Adding global FTS data')
+        latestyear = str(self.today.year)
+        slugified_name = slugify('FTS Requirements and Funding Data for All Countries').lower()
+        showcase_url = f'https://fts.unocha.org/global-funding/overview/{latestyear}'
+        dataset, showcase = get_dataset_and_showcase(slugified_name, 'Global - Requirements and Funding Data',
+                                                     self.notes, self.today, allcountries['name'], showcase_url,
+                                                     additional_tags=['covid-19'])
+        try:
+            dataset.add_other_location('world')
+        except HDXError as e:
+            logger.error(f'Global dataset has a problem! {e}')
+            return None, None, None, None
+        countries = [country for country in countries
+                     if country['name'] != 'World' and country['iso3'] in self.plans_by_year_by_country]
+        others_rows = {key: RowSpool(folder, self.memory) for key in self.others}
+        try:
+            with self.memory_stage('global'):
+                hxl_resource = self.reqfund.generate_global_resource(folder, dataset, self.plans_by_year_by_country,
+                                                                     countries, allcountries,
+                                                                     partial(self.call_others, others_rows))
+                resources = list()
+                if hxl_resource is not None:
+                    resources.append(hxl_resource)
+                    other_hxl_resource = self.generate_other_resources(others_rows, resources, folder, dataset,
+                                                                       allcountries)
+        finally:
+            for rows in others_rows.values():
+                rows.close()
+        if hxl_resource is None:
+            logger.warning('No global requirements or funding data available')
+            return None, None, None, None
+        if other_hxl_resource:
+            hxl_resource = other_hxl_resource
+        ordered_resource_names = self.get_ordered_resource_names(dataset, resources)
         return dataset, showcase, hxl_resource, ordered_resource_names
@@ -0,0 +1,97 @@
+import logging
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from hdx.utilities.saver import save_json
+
+from fts.requeststats import current_country, no_country
+
+logger = logging.getLogger(__name__)
+
+# Memory traced when the stage being run started and the most used since then that has been seen
+current_stage = ContextVar('current_stage', default=None)
+
+
+class MemoryAccounting:
+    '''Accounts for memory traced by tracemalloc by stage and country (see RequestStats.country). For each stage it
+    records the memory retained once the stage is done and the peak seen while it ran, sampled whenever a row store
+    checks the budget and at the end of the stage. If budget (bytes) is given, over_budget tells row stores to move
+    their rows to disk once a stage has grown by more than that. Memory is traced for the whole process so stages of
+    countries generated concurrently count each other's allocations. Tracing slows everything run while it is on and
+    uses memory of its own so stop should be called once the accounting is no longer needed.'''
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.lock = Lock()
+        self.stages = dict()
+        self.spills = 0
+        # only stop tracing if it was started here
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        state = {'start': tracemalloc.get_traced_memory()[0], 'peak': 0, 'spilled': False}
+        token = current_stage.set(state)
+        try:
+            yield
+        finally:
+            current_stage.reset(token)
+            retained = tracemalloc.get_traced_memory()[0] - state['start']
+            peak = max(state['peak'], retained)
+            key = (name, current_country.get() or no_country)
+            with self.lock:
+                totals = self.stages.get(key)
+                if totals is None:
+                    totals = {'calls': 0, 'retained': 0, 'peak': 0, 'spilled': False}
+                    self.stages[key] = totals
+                totals['calls'] += 1
+                totals['retained'] += retained
+                totals['peak'] = max(totals['peak'], peak)
+                totals['spilled'] = totals['spilled'] or state['spilled']
+
+    def over_budget(self):
+        state = current_stage.get()
+        if state is None:
+            return False
+        used = tracemalloc.get_traced_memory()[0] - state['start']
+        if used > state['peak']:
+            state['peak'] = used
+        if self.budget is None or used <= self.budget:
+            return False
+        state['spilled'] = True
+        with self.lock:
+            self.spills += 1
+        return True
+
+    def get_report(self):
+        with self.lock:
+            stages = dict(self.stages)
+        report = {'traced_peak': tracemalloc.get_traced_memory()[1], 'budget': self.budget, 'spills': self.spills,
+                  'stages': dict(), 'countries': dict()}
+        for (name, country), totals in sorted(stages.items()):
+            report['stages'].setdefault(name, dict())[country] = dict(totals)
+            country_totals = report['countries'].setdefault(country, {'peak': 0, 'stage': None})
+            if totals['peak'] > country_totals['peak']:
+                country_totals['peak'] = totals['peak']
+                country_totals['stage'] = name
+        return report
+
+    def get_summary(self, top=5):
+        report = self.get_report()
+        largest = sorted(((totals['peak'], name, country) for name, countries in report['stages'].items()
+                          for country, totals in countries.items()), reverse=True)[:top]
+        largest = ', '.join(f'{name} for {country} {peak / 1048576:.1f}MiB' for peak, name, country in largest)
+        return f'traced peak {report["traced_peak"] / 1048576:.1f}MiB, ' \
+               f'{report["spills"]} row stores moved to disk, largest stages: {largest}'
+
+    def save(self, path):
+        save_json(self.get_report(), path)
+
+    def stop(self):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
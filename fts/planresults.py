@@ -0,0 +1,50 @@
+from threading import Lock
+
+
+class PlanResults:
+    '''Stores results of per plan FTS calls so that each is only made once per run however many countries the plan
+    belongs to. Concurrent requests for the same plan wait for the first to finish rather than downloading again.'''
+
+    def __init__(self):
+        self.results = dict()
+        self.lock = Lock()
+        # locks of keys whose results are being got, removed once a result is stored
+        self.key_locks = dict()
+        self.hits = dict()
+        self.misses = dict()
+
+    def get_stored(self, kind, key):
+        '''Get a stored result, which must be called holding self.lock. Returns whether there is one and it.'''
+        if key not in self.results:
+            return False, None
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        return True, self.results[key]
+
+    def get(self, kind, planid, function):
+        key = (kind, planid)
+        with self.lock:
+            stored, result = self.get_stored(kind, key)
+            if stored:
+                return result
+            key_lock = self.key_locks.get(key)
+            if key_lock is None:
+                key_lock = Lock()
+                self.key_locks[key] = key_lock
+        with key_lock:
+            with self.lock:
+                # stored by the call that was waited for
+                stored, result = self.get_stored(kind, key)
+                if stored:
+                    return result
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+            result = function()
+            with self.lock:
+                self.results[key] = result
+                del self.key_locks[key]
+            return result
+
+    def get_summary(self):
+        summary = list()
+        for kind in sorted(self.misses):
+            summary.append(f'{kind}: {self.misses[kind]} calls, {self.hits.get(kind, 0)} saved')
+        return ', '.join(summary)
@@ -0,0 +1,176 @@
+import math
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import replace
+from threading import Lock
+
+from hdx.utilities.saver import save_json
+
+# Country for which requests are being made, set by the caller around per country work
+current_country = ContextVar('current_country', default=None)
+# (endpoint family, pattern) - the first pattern that matches is used
+endpoint_families = [
+    ('fts/flow/plan/overview/progress', r'fts/flow/plan/overview/progress'),
+    ('country/*/summary/trends', r'country/\d+/summary/trends'),
+    ('governingEntity', r'governingEntity'),
+    ('location', r'(^|/)location($|\?)'),
+    ('fts/flow', r'fts/flow'),
+]
+endpoint_families = [(family, re.compile(pattern)) for family, pattern in endpoint_families]
+quantiles = (0.5, 0.9, 0.99)
+no_country = 'all'
+
+
+def get_endpoint_family(url):
+    for family, pattern in endpoint_families:
+        if pattern.search(url):
+            return family
+    return 'other'
+
+
+def percentile(values, fraction):
+    '''Nearest rank percentile of sorted values'''
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class RequestStats:
+    '''Records latency, response size, time waiting on the rate limiter (and for a free downloader) and time parsing
+    and storing the response of every FTS request along with how many pages each nextLink chain took. Latency
+    percentiles are of requests made to FTS, not those answered from the cache or checkpoint. A request continues a chain if its url is the nextLink of an earlier response.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = list()
+        self.open_chains = dict()
+        self.chains = list()
+
+    @staticmethod
+    @contextmanager
+    def country(countryiso):
+        token = current_country.set(countryiso)
+        try:
+            yield
+        finally:
+            current_country.reset(token)
+
+    def record(self, url, endpoint, version, latency, size, wait, processing, cached, nextlink):
+        country = current_country.get() or no_country
+        with self.lock:
+            self.requests.append({'endpoint': endpoint, 'version': version, 'country': country, 'latency': latency,
+                                  'bytes': size, 'wait': wait, 'processing': processing, 'cached': cached})
+            chain = None
+            if url:
+                chain = self.open_chains.pop(url, None)
+            if chain is None:
+                chain = {'endpoint': endpoint, 'country': country, 'pages': 0}
+            chain['pages'] += 1
+            if nextlink:
+                self.open_chains[nextlink] = chain
+            else:
+                self.chains.append(chain)
+
+    @staticmethod
+    def get_totals(requests):
+        latencies = sorted(request['latency'] for request in requests if not request['cached'])
+        totals = {'requests': len(requests), 'cached': sum(1 for request in requests if request['cached']),
+                  'bytes': sum(request['bytes'] for request in requests), 'latency_total': sum(latencies),
+                  'ratelimit_wait_total': sum(request['wait'] for request in requests),
+                  'processing_total': sum(request['processing'] for request in requests),
+                  'latency_max': latencies[-1] if latencies else None}
+        for quantile in quantiles:
+            totals[f'latency_p{quantile * 100:g}'] = percentile(latencies, quantile)
+        versions = dict()
+        for request in requests:
+            versions[request['version']] = versions.get(request['version'], 0) + 1
+        totals['versions'] = versions
+        return totals
+
+    def get_report(self):
+        with self.lock:
+            requests = list(self.requests)
+            chains = list(self.chains)
+        by_endpoint = dict()
+        by_country = dict()
+        for request in requests:
+            by_endpoint.setdefault(request['endpoint'], list()).append(request)
+            by_country.setdefault(request['country'], list()).append(request)
+        pages_by_endpoint = dict()
+        for chain in chains:
+            pages_by_endpoint.setdefault(chain['endpoint'], list()).append(chain['pages'])
+        pagination = dict()
+        for endpoint, pages in sorted(pages_by_endpoint.items()):
+            pages = sorted(pages)
+            pagination[endpoint] = {'chains': len(pages), 'pages': sum(pages), 'pages_max': pages[-1]}
+            for quantile in quantiles:
+                pagination[endpoint][f'pages_p{quantile * 100:g}'] = percentile(pages, quantile)
+        return {'total': self.get_totals(requests),
+                'endpoints': {key: self.get_totals(value) for key, value in sorted(by_endpoint.items())},
+                'countries': {key: self.get_totals(value) for key, value in sorted(by_country.items())},
+                'pagination': pagination}
+
+    def get_summary(self):
+        report = self.get_report()
+        summary = list()
+        for endpoint, totals in report['endpoints'].items():
+            summary.append(f'{endpoint}: {totals["requests"]} requests ({totals["cached"]} cached), '
+                           f'{totals["bytes"]} bytes, {totals["latency_total"]:.1f}s')
+        return ', '.join(summary)
+
+    @staticmethod
+    def get_prometheus_lines(report):
+        lines = list()
+
+        def add_metric(name, metrictype, helptext, samples):
+            lines.append(f'# HELP {name} {helptext}')
+            lines.append(f'# TYPE {name} {metrictype}')
+            for labels, value in samples:
+                if value is None:
+                    continue
+                labels = ','.join(f'{labelname}="{labelvalue}"' for labelname, labelvalue in labels)
+                lines.append(f'{name}{{{labels}}} {value}')
+
+        for scope, label in (('endpoints', 'endpoint'), ('countries', 'country')):
+            prefix = f'fts_{label}'
+            totals = report[scope]
+            add_metric(f'{prefix}_requests_total', 'counter', f'FTS requests by {label}',
+                       [(((label, key), ('version', version)), count) for key, value in totals.items()
+                        for version, count in sorted(value['versions'].items())])
+            add_metric(f'{prefix}_cached_requests_total', 'counter', f'FTS requests served from cache by {label}',
+                       [(((label, key),), value['cached']) for key, value in totals.items()])
+            add_metric(f'{prefix}_response_bytes_total', 'counter', f'FTS response bytes by {label}',
+                       [(((label, key),), value['bytes']) for key, value in totals.items()])
+            add_metric(f'{prefix}_ratelimit_wait_seconds_total', 'counter',
+                       f'Time waiting on the rate limiter by {label}',
+                       [(((label, key),), value['ratelimit_wait_total']) for key, value in totals.items()])
+            add_metric(f'{prefix}_processing_seconds_total', 'counter',
+                       f'Time parsing and storing FTS responses by {label}',
+                       [(((label, key),), value['processing_total']) for key, value in totals.items()])
+            add_metric(f'{prefix}_latency_seconds', 'summary', f'FTS request latency by {label}',
+                       [(((label, key), ('quantile', f'{quantile:g}')), value[f'latency_p{quantile * 100:g}'])
+                        for key, value in totals.items() for quantile in quantiles])
+            lines.extend(f'{prefix}_latency_seconds_sum{{{label}="{key}"}} {value["latency_total"]}'
+                         for key, value in totals.items())
+            lines.extend(f'{prefix}_latency_seconds_count{{{label}="{key}"}} {value["requests"] - value["cached"]}'
+                         for key, value in totals.items())
+        pagination = report['pagination']
+        add_metric('fts_pagination_pages', 'summary', 'Pages per nextLink chain by endpoint',
+                   [((('endpoint', key), ('quantile', f'{quantile:g}')), value[f'pages_p{quantile * 100:g}'])
+                    for key, value in pagination.items() for quantile in quantiles])
+        lines.extend(f'fts_pagination_pages_sum{{endpoint="{key}"}} {value["pages"]}'
+                     for key, value in pagination.items())
+        lines.extend(f'fts_pagination_pages_count{{endpoint="{key}"}} {value["chains"]}'
+                     for key, value in pagination.items())
+        return lines
+
+    def save(self, jsonpath, prometheuspath):
+        report = self.get_report()
+        save_json(report, jsonpath)
+        # textfile collectors may read at any time so write to a temporary file and move it into place
+        temppath = f'{prometheuspath}.tmp'
+        with open(temppath, 'w') as f:
+            f.write('\n'.join(self.get_prometheus_lines(report)))
+            f.write('\n')
+        replace(temppath, prometheuspath)
@@ -1,18 +1,51 @@
 import logging
 
-from fts.helpers import hxl_names
+from fts.helpers import hxl_names, groupby_select, write_resource_from_iterator
 
 logger = logging.getLogger(__name__)
 
+columns = ['countryCode', 'id', 'name', 'code', 'typeId', 'typeName', 'startDate', 'endDate', 'year', 'requirements',
+           'funding', 'percentFunded']
+
 
 class RequirementsFunding:
-    def __init__(self, downloader, locations, globalplanids, today):
+    def __init__(self, downloader, locations, globalplanids, today, parquet=False):
         self.downloader = downloader
+        self.parquet = parquet
         self.locations = locations
         self.globalplanids = globalplanids
         self.today = today
+        self.country_requirements_funding = dict()
+        self.funding_by_country = dict()
+
+    def set_country_requirements_funding(self, year, planid, countryid, requirements, funding, percentFunded=None):
+        # a plan can be in the overviews of several years with different figures in each
+        self.country_requirements_funding[(year, planid, countryid)] = {'requirements': requirements,
+                                                                        'funding': funding,
+                                                                        'percentFunded': percentFunded}
+
+    def get_country_requirements_funding(self, year, planid, countryid):
+        return self.country_requirements_funding.get((year, planid, countryid), dict())
 
-    def add_country_requirements_funding(self, planid, plan, countries):
+    @staticmethod
+    def get_location_funding_url(planid):
+        return f'fts/flow?planid={planid}&groupby=location'
+
+    def download_location_funding(self, plans):
+        '''Download the location breakdowns needed by add_country_requirements_funding for plans concurrently'''
+        planids = list()
+        for plan in plans:
+            planid = plan['id']
+            countries = plan['countries']
+            if not countries or len(countries) == 1 or plan.get('customLocationCode') == 'COVD':
+                continue
+            if planid not in planids:
+                planids.append(planid)
+        datas = self.downloader.download_many([{'partial_url': self.get_location_funding_url(planid),
+                                                'select': groupby_select} for planid in planids])
+        return dict(zip(planids, datas))
+
+    def add_country_requirements_funding(self, year, planid, plan, countries, data=None):
         if len(countries) == 1:
             requirements = plan.get('requirements')
             if requirements is not None:
@@ -23,16 +56,14 @@ class RequirementsFunding:
             else:
                 progress = funding.get('progress')
                 funding = funding.get('totalFunding')
-            countries[0]['requirements'] = requirements
-            countries[0]['funding'] = funding
             if progress:
                 progress = int(progress + 0.5)
-            countries[0]['percentFunded'] = progress
+            self.set_country_requirements_funding(year, planid, countries[0]['id'], requirements, funding, progress)
         else:
             if plan.get('customLocationCode') == 'COVD':
                 return True
-            funding_url = f'fts/flow?planid={planid}&groupby=location'
-            data = self.downloader.download(funding_url)
+            if data is None:
+                data = self.downloader.download(self.get_location_funding_url(planid), select=groupby_select)
             requirements = data.get('requirements')
             country_requirements = dict()
             if requirements is not None:
@@ -59,11 +90,13 @@ class RequirementsFunding:
             for country in countries:
                 countryid = country['id']
                 requirements = country_requirements.get(countryid)
-                country['requirements'] = requirements
                 funding = country_funding.get(countryid)
-                country['funding'] = funding
                 if requirements is not None and funding is not None:
-                    country['percentFunded'] = int(funding / requirements * 100 + 0.5)
+                    percentFunded = int(funding / requirements * 100 + 0.5)
+                else:
+                    percentFunded = None
+                self.set_country_requirements_funding(year, planid, countryid, requirements, funding,
+                                                      percentFunded)
         return False
 
     def get_country_funding(self, countryid, plans_by_year, start_year=2010):
@@ -79,54 +112,85 @@ class RequirementsFunding:
                     funding_by_year[year] = funding
         return funding_by_year
 
-    def generate_resource(self, folder, dataset, plans_by_year, country, call_others=lambda x: None):
+    def get_plan_rows(self, plans, year, countryiso):
+        '''Get the plan rows of a country for a year sorted for output along with their funding in plan order for
+        working out funding not specified against a plan. Rows are built when the country is generated rather than
+        for all countries up front so that only those of the country being generated are held.'''
+        subrows = list()
+        for plan in plans:
+            planid = plan['id']
+            if planid in self.globalplanids:
+                continue
+            found_other_countries = False
+            for country in plan['countries']:
+                adminlevel = country.get('adminlevel', country.get('adminLevel'))
+                if adminlevel == 0 and country['iso3'] != countryiso:
+                    found_other_countries = True
+                    continue
+                requirements_funding = self.get_country_requirements_funding(year, planid, country['id'])
+                row = {'countryCode': countryiso, 'id': planid, 'name': plan['name'], 'code': plan['code'],
+                       'typeId': plan['planType']['id'], 'typeName': plan['planType']['id'],
+                       'startDate': plan['startDate'], 'endDate': plan['endDate'], 'year': year,
+                       'requirements': requirements_funding.get('requirements', ''),
+                       'funding': requirements_funding.get('funding', ''),
+                       'percentFunded': requirements_funding.get('percentFunded', '')}
+                subrows.append(row)
+
+            if found_other_countries:
+                logger.warning('Plan %s spans multiple locations - ignoring in cluster breakdown!' % planid)
+        fundings = [row['funding'] for row in subrows]
+        return sorted(subrows, key=lambda k: (k['typeId'], k['id'])), fundings
+
+    def get_funding_by_year(self, plans_by_year, country):
+        '''Get the funding by year of a country, which is kept so that it is not downloaded again'''
         countryiso = country['iso3']
-        funding_by_year = self.get_country_funding(country['id'], plans_by_year)
-        rows = list()
+        funding_by_year = self.funding_by_country.get(countryiso)
+        if funding_by_year is None:
+            funding_by_year = self.get_country_funding(country['id'], plans_by_year)
+            self.funding_by_country[countryiso] = funding_by_year
+        return funding_by_year
+
+    def get_rows(self, plans_by_year, country, call_others=lambda x: None):
+        '''Yield the rows of a country calling call_others with each plan row'''
+        countryiso = country['iso3']
+        funding_by_year = self.get_funding_by_year(plans_by_year, country)
 
         all_years = sorted(set(plans_by_year.keys()) | set(funding_by_year.keys()), reverse=True)
         for year in all_years:
             not_specified_funding = funding_by_year.get(year, '')
-            subrows = list()
-            for plan in plans_by_year.get(year, list()):
-                planid = plan['id']
-                if planid in self.globalplanids:
-                    continue
-                found_other_countries = False
-                for country in plan['countries']:
-                    adminlevel = country.get('adminlevel', country.get('adminLevel'))
-                    if adminlevel == 0 and country['iso3'] != countryiso:
-                        found_other_countries = True
-                        continue
-                    requirements = country.get('requirements', '')
-                    funding = country.get('funding', '')
-                    percentFunded = country.get('percentFunded', '')
-                    if not_specified_funding and funding:
-                        not_specified_funding -= funding
-                    row = {'countryCode': countryiso, 'id': planid, 'name': plan['name'], 'code': plan['code'],
-                           'typeId': plan['planType']['id'], 'typeName': plan['planType']['id'],
-                           'startDate': plan['startDate'], 'endDate': plan['endDate'], 'year': year,
-                           'requirements': requirements, 'funding': funding, 'percentFunded': percentFunded}
-                    subrows.append(row)
-
-                if found_other_countries:
-                    logger.warning('Plan %s spans multiple locations - ignoring in cluster breakdown!' % planid)
-                    continue
-            for row in sorted(subrows, key=lambda k: (k['typeId'], k['id'])):
-                rows.append(row)
+            subrows, fundings = self.get_plan_rows(plans_by_year.get(year, list()), year, countryiso)
+            for funding in fundings:
+                if not_specified_funding and funding:
+                    not_specified_funding -= funding
+            for row in subrows:
+                yield row
                 call_others(row)
 
-            rows.append({'countryCode': countryiso, 'id': '', 'name': 'Not specified', 'code': '', 'typeId': '',
-                         'typeName': '', 'startDate': '', 'endDate': '', 'year': year, 'requirements': '',
-                         'funding': not_specified_funding, 'percentFunded': ''})
-        if not rows:
-            return None
-        headers = list(rows[0].keys())
-        filename = f'fts_requirements_funding_{countryiso.lower()}.csv'
+            yield {'countryCode': countryiso, 'id': '', 'name': 'Not specified', 'code': '', 'typeId': '',
+                   'typeName': '', 'startDate': '', 'endDate': '', 'year': year, 'requirements': '',
+                   'funding': not_specified_funding, 'percentFunded': ''}
+
+    def write_resource(self, folder, dataset, rows, country):
+        filename = f'fts_requirements_funding_{country["iso3"].lower()}.csv'
         resourcedata = {
             'name': filename.lower(),
             'description': f'FTS Annual Requirements and Funding Data for {country["name"]}',
             'format': 'csv'
         }
-        success, results = dataset.generate_resource_from_iterator(headers, rows, hxl_names, folder, filename, resourcedata)
-        return results['resource']
+        success, results = write_resource_from_iterator(dataset, columns, rows, hxl_names, folder, filename,
+                                                        resourcedata, parquet=self.parquet)
+        if success:
+            return results['resource']
+        else:
+            return None
+
+    def generate_resource(self, folder, dataset, plans_by_year, country, call_others=lambda x: None):
+        return self.write_resource(folder, dataset, self.get_rows(plans_by_year, country, call_others), country)
+
+    def generate_global_resource(self, folder, dataset, plans_by_year_by_country, countries, allcountries,
+                                 call_others=lambda x: None):
+        '''Write the rows of all countries into one resource named for allcountries, streaming them one country at
+        a time'''
+        rows = (row for country in countries
+                for row in self.get_rows(plans_by_year_by_country.get(country['iso3']), country, call_others))
+        return self.write_resource(folder, dataset, rows, allcountries)
@@ -1,25 +1,34 @@
-import copy
 import logging
 
 from hdx.utilities.downloader import DownloadError
 
-from fts.helpers import hxl_names
+from fts.helpers import hxl_names, groupby_select, write_resource_from_iterator
+from fts.rowstore import DerivedRow, get_first_row
 
 logger = logging.getLogger(__name__)
 
+# Columns of plan rows replaced by the cluster columns
+plan_only_columns = frozenset(('typeId', 'typeName', 'requirements', 'funding', 'percentFunded'))
+
 
 class RequirementsFundingCluster:
-    def __init__(self, downloader, locations, planidswithonelocation, clusterlevel=''):
+    def __init__(self, downloader, locations, planidswithonelocation, planresults, clusterlevel='', parquet=False):
         self.downloader = downloader
+        self.parquet = parquet
         self.locations = locations
         self.planidswithonelocation = planidswithonelocation
+        self.planresults = planresults
         self.clusterlevel = clusterlevel
-        self.rows = list()
 
     def get_requirements_funding_plan(self, inrow):
         planid = inrow['id']
+        return self.planresults.get(f'{self.clusterlevel}cluster', planid,
+                                    lambda: self.download_requirements_funding_plan(planid))
+
+    def download_requirements_funding_plan(self, planid):
         try:
-            data = self.downloader.download(f'fts/flow?planid={planid}&groupby={self.clusterlevel}cluster')
+            data = self.downloader.download(f'fts/flow?planid={planid}&groupby={self.clusterlevel}cluster',
+                                            select=groupby_select)
         except DownloadError:
             logger.error(f'Problem with downloading cluster data for {planid}!')
             return None, None, None, None
@@ -50,27 +59,17 @@ class RequirementsFundingCluster:
         return requirements_clusters, funding_clusters, notspecified, shared
 
     @staticmethod
-    def create_row(base_row, clusterid='', name='', requirements='', funding='', percentFunded=''):
-        row = copy.deepcopy(base_row)
-        row['clusterCode'] = clusterid
-        row['cluster'] = name
-        row['requirements'] = requirements
-        row['funding'] = funding
-        row['percentFunded'] = percentFunded
-        return row
+    def create_row(inrow, clusterid='', name='', requirements='', funding='', percentFunded=''):
+        return DerivedRow(inrow, {'clusterCode': clusterid, 'cluster': name, 'requirements': requirements,
+                                  'funding': funding, 'percentFunded': percentFunded}, plan_only_columns)
 
-    def generate_rows_requirements_funding(self, inrow, requirements_clusters, funding_clusters, notspecified, shared):
+    def generate_rows_requirements_funding(self, rows, inrow, requirements_clusters, funding_clusters, notspecified,
+                                           shared):
         if requirements_clusters is None and funding_clusters is None:
             return
         planid = inrow['id']
         if planid not in self.planidswithonelocation:
             return
-        base_row = copy.deepcopy(inrow)
-        del base_row['typeId']
-        del base_row['typeName']
-        del base_row['requirements']
-        del base_row['funding']
-        del base_row['percentFunded']
         subrows = list()
         for clusterid, (fundname, funding) in funding_clusters.items():
             requirements_cluster = requirements_clusters.get(clusterid)
@@ -80,7 +79,7 @@ class RequirementsFundingCluster:
                 reqname, requirements = requirements_cluster
                 if not fundname:
                     fundname = reqname
-            row = self.create_row(base_row, clusterid, fundname, requirements, funding)
+            row = self.create_row(inrow, clusterid, fundname, requirements, funding)
             if requirements and funding != '':
                 row['percentFunded'] = int(funding / requirements * 100 + 0.5)
             else:
@@ -91,24 +90,25 @@ class RequirementsFundingCluster:
         for clusterid, (reqname, requirements) in requirements_clusters.items():
             if clusterid in fundclusterids:
                 continue
-            row = self.create_row(base_row, clusterid, reqname, requirements)
+            row = self.create_row(inrow, clusterid, reqname, requirements)
             subrows.append(row)
 
-        self.rows.extend(sorted(subrows, key=lambda k: k['cluster']))
+        rows.extend(sorted(subrows, key=lambda k: k['cluster']))
 
-        row = self.create_row(base_row, name='Not specified', funding=notspecified)
-        self.rows.append(row)
-        row = self.create_row(base_row, name='Multiple clusters/sectors (shared)', funding=shared)
-        self.rows.append(row)
+        row = self.create_row(inrow, name='Not specified', funding=notspecified)
+        rows.append(row)
+        row = self.create_row(inrow, name='Multiple clusters/sectors (shared)', funding=shared)
+        rows.append(row)
 
-    def generate_plan_requirements_funding(self, inrow):
+    def generate_plan_requirements_funding(self, rows, inrow):
         requirements_clusters, funding_clusters, notspecified, shared = self.get_requirements_funding_plan(inrow)
-        self.generate_rows_requirements_funding(inrow, requirements_clusters, funding_clusters, notspecified, shared)
+        self.generate_rows_requirements_funding(rows, inrow, requirements_clusters, funding_clusters, notspecified,
+                                                shared)
 
-    def generate_resource(self, folder, dataset, country):
-        if not self.rows:
+    def generate_resource(self, rows, folder, dataset, country):
+        if not rows:
             return None
-        headers = list(self.rows[0].keys())
+        headers = list(get_first_row(rows).keys())
         filename = f'fts_requirements_funding_{self.clusterlevel}cluster_{country["iso3"].lower()}.csv'
         description = f'FTS Annual Requirements and Funding Data by Cluster for {country["name"]}'
         if self.clusterlevel:
@@ -118,9 +118,8 @@ class RequirementsFundingCluster:
             'description': description,
             'format': 'csv'
         }
-        success, results = dataset.generate_resource_from_iterator(headers, self.rows, hxl_names, folder, filename,
-                                                                   resourcedata)
-        self.rows = list()
+        success, results = write_resource_from_iterator(dataset, headers, rows, hxl_names, folder, filename,
+                                                        resourcedata, parquet=self.parquet)
         if success:
             return results['resource']
         else:
@@ -1,71 +1,133 @@
-import copy
 import logging
+import time
+from os import replace
+from os.path import exists
 
-from fts.helpers import hxl_names
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+from fts.download import day
+from fts.helpers import hxl_names, groupby_select, write_resource_from_iterator
+from fts.rowstore import DerivedRow, get_first_row
 
 logger = logging.getLogger(__name__)
 
+# Time to live in seconds of the known COVID funding of plans that have ended after which FTS is queried again in
+# case it has been corrected
+known_funding_ttl = 30 * day
+
 
 class RequirementsFundingCovid:
-    def __init__(self, downloader, plans_by_year_by_country):
+    def __init__(self, downloader, plans_by_year_by_country, planresults, currentyear=None, known_path=None,
+                 batch_size=50, parquet=False):
         self.downloader = downloader
+        self.planresults = planresults
+        self.parquet = parquet
         self.covidfundingbyplan = dict()
-        self.rows = list()
-        self.get_covid_funding(plans_by_year_by_country)
+        self.get_covid_funding(plans_by_year_by_country, currentyear, known_path, batch_size)
 
-    def clear_rows(self):
-        self.rows = list()
+    @staticmethod
+    def load_known_funding(path, ttl=known_funding_ttl):
+        '''Load known funding and when it was queried by plan id, leaving out any queried more than ttl seconds ago'''
+        if path is None or not exists(path):
+            return dict()
+        now = time.time()
+        # funding stored without when it was queried has expired
+        return {entry[0]: (entry[1], entry[2]) for entry in load_json(path)
+                if len(entry) == 3 and now - entry[2] <= ttl}
 
-    def get_covid_funding(self, plans_by_year_by_country, covidstartyear=2020):
-        planids = set()
+    @staticmethod
+    def save_known_funding(known_funding, path):
+        temppath = f'{path}.tmp'
+        save_json(sorted([planid, funding, queried] for planid, (funding, queried) in known_funding.items()),
+                  temppath)
+        replace(temppath, path)
+
+    def get_covid_funding(self, plans_by_year_by_country, currentyear=None, known_path=None, batch_size=50,
+                          covidstartyear=2020):
+        '''Get COVID funding of plans since covidstartyear. Plan ids are queried in batches of batch_size which are
+        downloaded concurrently. If known_path is given, the funding of plans that ended before the year before
+        currentyear, which is still reported, is kept there and those plans are not queried again in later runs
+        until it expires after known_funding_ttl.'''
+        lastyear_by_planid = dict()
         for plans_by_year in plans_by_year_by_country.values():
-            for year in plans_by_year:
+            for year, plans in plans_by_year.items():
                 if year < covidstartyear:
                     continue
-                planids.update(str(plan['id']) for plan in plans_by_year[year])
-        planids = ','.join(sorted(planids))
-        data = self.downloader.download(f'fts/flow?emergencyid=911&planid={planids}&groupby=plan')
-        for fundingobject in data['report3']['fundingTotals']['objects'][0]['singleFundingObjects']:
-            self.covidfundingbyplan[fundingobject['id']] = fundingobject['totalFunding']
+                for plan in plans:
+                    planid = plan['id']
+                    lastyear_by_planid[planid] = max(year, lastyear_by_planid.get(planid, year))
+        known_funding = self.load_known_funding(known_path)
+        planids = sorted(str(planid) for planid in lastyear_by_planid if planid not in known_funding)
+        batches = [planids[i:i + batch_size] for i in range(0, len(planids), batch_size)]
+        datas = self.downloader.download_many([{'partial_url': f'fts/flow?emergencyid=911&planid={",".join(batch)}'
+                                                               f'&groupby=plan', 'select': groupby_select}
+                                               for batch in batches])
+        for batch, data in zip(batches, datas):
+            fund_objects = data['report3']['fundingTotals']['objects']
+            if len(fund_objects) == 0:
+                logger.info(f'Plans {",".join(batch)} have no COVID funding')
+                continue
+            for fundingobject in fund_objects[0]['singleFundingObjects']:
+                self.covidfundingbyplan[fundingobject['id']] = fundingobject['totalFunding']
+        for planid, (funding, _) in known_funding.items():
+            if planid in lastyear_by_planid:
+                self.covidfundingbyplan[planid] = funding
+        if known_path is None or currentyear is None:
+            return
+        # plans with no COVID funding are not returned so their funding is stored as 0
+        now = time.time()
+        new_known_funding = {planid: (self.covidfundingbyplan.get(planid, 0), now)
+                             for planid, lastyear in lastyear_by_planid.items()
+                             if lastyear < currentyear - 1 and planid not in known_funding}
+        if new_known_funding:
+            known_funding.update(new_known_funding)
+            self.save_known_funding(known_funding, known_path)
+        logger.info(f'COVID funding queried for {len(planids)} plans in {len(batches)} batches, '
+                    f'{len(known_funding) - len(new_known_funding)} plans already known')
 
-    def generate_plan_requirements_funding(self, inrow, requirements_clusters):
-        planid = inrow['id']
+    def download_covid_ids(self, planid):
         data = self.downloader.download(f'public/governingEntity?planId={planid}&scopes=governingEntityVersion', use_v2=True)
         covid_ids = set()
         for clusterobj in data:
             tags = clusterobj['governingEntityVersion'].get('tags')
             if tags and 'COVID-19' in tags:
                 covid_ids.add(clusterobj['id'])
+        return covid_ids
+
+    def get_covid_ids(self, planid):
+        return self.planresults.get('governingEntity', planid, lambda: self.download_covid_ids(planid))
+
+    def generate_plan_requirements_funding(self, rows, inrow, requirements_clusters):
+        planid = inrow['id']
+        covid_ids = self.get_covid_ids(planid)
         if len(covid_ids) == 0:
             logger.info('%s has no COVID component!' % planid)
             return
-        row = copy.deepcopy(inrow)
         covidrequirements = 0
         for clusterid, (_, requirements) in requirements_clusters.items():
             if clusterid in covid_ids:
                 covidrequirements += requirements
-        row['requirements'] = covidrequirements
         covidfunding = self.covidfundingbyplan.get(planid, 0)
-        row['funding'] = covidfunding
         if covidrequirements == 0:
-            row['percentFunded'] = ''
+            percentfunded = ''
         else:
-            row['percentFunded'] = int(covidfunding / covidrequirements * 100 + 0.5)
-        self.rows.append(row)
+            percentfunded = int(covidfunding / covidrequirements * 100 + 0.5)
+        rows.append(DerivedRow(inrow, {'requirements': covidrequirements, 'funding': covidfunding,
+                                       'percentFunded': percentfunded}))
 
-    def generate_resource(self, folder, dataset, country):
-        if not self.rows:
+    def generate_resource(self, rows, folder, dataset, country):
+        if not rows:
             return None
-        headers = list(self.rows[0].keys())
+        headers = list(get_first_row(rows).keys())
         filename = f'fts_requirements_funding_covid_{country["iso3"].lower()}.csv'
         resourcedata = {
             'name': filename,
             'description': f'FTS Annual Covid Requirements and Funding Data for {country["name"]}',
             'format': 'csv'
         }
-        success, results = dataset.generate_resource_from_iterator(headers, self.rows, hxl_names, folder, filename,
-                                                                   resourcedata)
-        self.rows = list()
+        success, results = write_resource_from_iterator(dataset, headers, rows, hxl_names, folder, filename,
+                                                        resourcedata, parquet=self.parquet)
         if success:
             return results['resource']
         else:
@@ -0,0 +1,193 @@
+import heapq
+import json
+from collections.abc import Mapping
+from os import close, remove
+from tempfile import mkstemp
+
+# Rows appended between checks of the memory budget
+budget_check_rows = 1000
+
+
+class ExternalSorter:
+    '''Collects rows and iterates over them sorted by key. If max_rows is given, whenever that many rows have been
+    collected they are sorted and spilled to a run file on disk. Iterating then merges the runs so that only one row
+    per run is held in memory. Sorting is stable across runs as it is for sorted. If memory (a MemoryAccounting) is
+    given and goes over budget, the rows are spilled and from then on runs of that many rows are spilled.'''
+
+    def __init__(self, key, reverse=False, max_rows=None, folder=None, memory=None):
+        self.key = key
+        self.reverse = reverse
+        self.max_rows = max_rows
+        self.folder = folder
+        self.memory = memory
+        self.rows = list()
+        self.runs = list()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        self.rows.append(row)
+        self.count += 1
+        if self.max_rows and len(self.rows) >= self.max_rows:
+            self.spill()
+        elif self.memory and self.count % budget_check_rows == 0 and self.memory.over_budget():
+            self.max_rows = len(self.rows)
+            self.memory = None
+            self.spill()
+
+    def spill(self):
+        self.rows.sort(key=self.key, reverse=self.reverse)
+        fd, path = mkstemp(suffix='.jsonl', dir=self.folder)
+        close(fd)
+        with open(path, 'w', encoding='utf-8') as f:
+            for row in self.rows:
+                f.write(json.dumps(row))
+                f.write('\n')
+        self.runs.append(path)
+        self.rows = list()
+
+    @staticmethod
+    def read_run(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def __iter__(self):
+        self.rows.sort(key=self.key, reverse=self.reverse)
+        if not self.runs:
+            return iter(self.rows)
+        iterators = [self.read_run(path) for path in self.runs]
+        iterators.append(iter(self.rows))
+        return heapq.merge(*iterators, key=self.key, reverse=self.reverse)
+
+    def save(self, path):
+        '''Write the sorted rows to a file that can be read with RowFile'''
+        with open(path, 'w', encoding='utf-8') as f:
+            for row in self:
+                f.write(json.dumps(row))
+                f.write('\n')
+
+    def close(self):
+        for path in self.runs:
+            remove(path)
+        self.runs = list()
+        self.rows = list()
+
+
+class RowFile:
+    '''Rows saved in a file by ExternalSorter.save which are read as they are iterated over. Closing leaves the file
+    in place.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        return ExternalSorter.read_run(self.path)
+
+    def close(self):
+        pass
+
+
+class DerivedRow(Mapping):
+    '''A row derived from a base row with the keys in drop removed and those in values set, which refers to the base
+    row rather than copying it so the base row must not change. Keys are in the order of the base row's without those
+    removed followed by those set that are not in it, as if the base row had been copied and changed.'''
+    __slots__ = ('base', 'values', 'drop')
+
+    def __init__(self, base, values, drop=frozenset()):
+        self.base = base
+        self.values = values
+        self.drop = drop
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        if key in self.drop:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.drop:
+                yield key
+        for key in self.values:
+            if key not in self.base or key in self.drop:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def get_first_row(rows):
+    '''Get the first of rows, closing the iterator used so that a file of rows is not left open'''
+    iterator = iter(rows)
+    try:
+        return next(iterator)
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+def dump_row(row):
+    if isinstance(row, DerivedRow):
+        row = dict(row)
+    return json.dumps(row)
+
+
+class RowSpool:
+    '''Rows kept in the order they are appended. They are held in memory unless memory (a MemoryAccounting) goes over
+    budget, when they are moved to a file on disk to which later rows are also written.'''
+
+    def __init__(self, folder=None, memory=None):
+        self.folder = folder
+        self.memory = memory
+        self.rows = list()
+        self.path = None
+        self.file = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        self.count += 1
+        if self.file is not None:
+            self.file.write(dump_row(row))
+            self.file.write('\n')
+            return
+        self.rows.append(row)
+        if self.memory and self.count % budget_check_rows == 0 and self.memory.over_budget():
+            self.spill()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def spill(self):
+        fd, self.path = mkstemp(suffix='.jsonl', dir=self.folder)
+        close(fd)
+        self.file = open(self.path, 'w', encoding='utf-8')
+        rows = self.rows
+        self.rows = list()
+        for row in rows:
+            self.file.write(dump_row(row))
+            self.file.write('\n')
+
+    def __iter__(self):
+        if self.file is None:
+            return iter(self.rows)
+        self.file.flush()
+        return ExternalSorter.read_run(self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            remove(self.path)
+            self.file = None
+        self.rows = list()
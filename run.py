@@ -10,16 +10,22 @@ that register datasets in HDX.
 '''
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from os import makedirs
 from os.path import join, expanduser
 
 from hdx.hdx_configuration import Configuration
 from hdx.utilities.downloader import Download
-from hdx.utilities.path import progress_storing_tempdir
+from hdx.utilities.path import progress_storing_tempdir, get_temp_dir, temp_dir
 
-from fts.download import FTSDownload
-from fts.locations import Locations
-from fts.main import FTS
+from fts.archive import ResponseArchive
+from fts.download import FTSDownload, FTSCache, FTSCheckpoint, FTSException
+from fts.fingerprints import Fingerprints
+from fts.locations import Locations, snapshot_ttl as locations_snapshot_ttl
+from fts.main import FTS, allcountries
+from fts.memory import MemoryAccounting
 
 from hdx.facades.simple import facade
 
@@ -33,48 +39,239 @@ def parse_args():
     parser.add_argument('-c', '--countries', default=None, help='Countries to run')
     parser.add_argument('-y', '--years', default=None, help='Years to run')
     parser.add_argument('-t', '--testfolder', default=None, help='Output test data to folder')
+    parser.add_argument('-w', '--workers', default=1, type=int, help='Number of countries to generate concurrently')
+    parser.add_argument('-ng', '--no-global', default=False, action='store_true',
+                        help='Do not publish the dataset combining all countries')
+    parser.add_argument('-pq', '--publish-queue', default=1, type=int,
+                        help='Number of generated countries that may wait to be published')
+    parser.add_argument('-cd', '--cache-dir', default=None,
+                        help='Folder in which to cache FTS responses (not cached by default)')
+    parser.add_argument('-cm', '--cache-max-size', default=1024, type=int,
+                        help='Size in MiB above which least recently used cached responses are removed')
+    parser.add_argument('-nk', '--no-checkpoint', default=False, action='store_true',
+                        help='Do not checkpoint FTS responses for resuming part way through a country')
+    parser.add_argument('-fs', '--flow-spill-rows', default=None, type=int,
+                        help='Spill flow rows to disk in sorted runs of this size')
+    parser.add_argument('-ma', '--memory-accounting', default=False, action='store_true',
+                        help='Account for memory used by stage and country')
+    parser.add_argument('-mb', '--memory-budget', default=None, type=int,
+                        help='Move rows to disk once a stage has grown by this many MiB')
+    parser.add_argument('-pf', '--parquet', default=False, action='store_true',
+                        help='Also output each resource as Parquet (needs pyarrow)')
+    parser.add_argument('-bf', '--bulk-flows', default=False, action='store_true',
+                        help='Download flows for all locations in one query')
+    parser.add_argument('-rl', '--refresh-locations', default=False, action='store_true',
+                        help='Download FTS locations rather than using the snapshot made by an earlier run')
+    parser.add_argument('-i', '--incremental', default=False, action='store_true',
+                        help='Skip countries whose FTS data is unchanged since they were last published')
+    parser.add_argument('-f', '--full', default=False, action='store_true',
+                        help='In incremental mode, publish all countries anyway')
+    parser.add_argument('-fy', '--flow-years', default=1, type=int,
+                        help='Number of years of flows to export including the current year')
+    parser.add_argument('-pd', '--partitions-dir', default=None,
+                        help='Folder in which to keep flows of past years for reuse')
+    parser.add_argument('-rr', '--request-report', default=None,
+                        help='Folder in which to write JSON and Prometheus reports of FTS requests')
+    parser.add_argument('-ra', '--record-archive', default=None,
+                        help='Record FTS responses into a zip archive for offline replay')
     args = parser.parse_args()
     return args
 
 
+def generate_country(fts, folder, country):
+    with fts.downloader.stats.country(country['iso3']):
+        return fts.generate_dataset_and_showcase(folder, country)
+
+
+def country_done(fts, country):
+    if fts.downloader.checkpoint:
+        fts.downloader.checkpoint.done(country['iso3'])
+
+
+def generate_countries(fts, countries, workers=1, queue_size=1, failures=None):
+    '''Generate country datasets in order using up to workers threads. Generation runs ahead of the caller, which
+    publishes each country yielded, by up to queue_size countries plus those being generated, so that FTS downloads
+    overlap HDX uploads while bounding how many generated countries are held. Progress is only stored for the country
+    being yielded so resuming from the progress storing tempdir regenerates any lookahead work, reusing any responses
+    checkpointed for it. A country's checkpoint is removed once the caller has finished with it. If failures is given,
+    a country whose generation fails is logged, added to it by iso3 and yielded with a result of None rather than
+    stopping the run.'''
+    lookahead = max(workers, 1) + queue_size
+    index_by_iso3 = {country['iso3']: i for i, country in enumerate(countries)}
+    futures = dict()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        try:
+            for info, country in progress_storing_tempdir('FTS', countries, 'iso3'):
+                index = index_by_iso3[country['iso3']]
+                for nextcountry in countries[index:index + lookahead]:
+                    countryiso = nextcountry['iso3']
+                    if countryiso not in futures:
+                        futures[countryiso] = executor.submit(generate_country, fts, info['folder'], nextcountry)
+                future = futures.pop(country['iso3'])
+                if failures is None:
+                    result = future.result()
+                else:
+                    try:
+                        result = future.result()
+                    except Exception as ex:
+                        logger.exception(f'Generating {country["name"]} failed!')
+                        failures[country['iso3']] = f'generation: {ex}'
+                        result = None
+                yield info, country, result
+                country_done(fts, country)
+        finally:
+            # do not generate lookahead countries when stopping early
+            for future in futures.values():
+                future.cancel()
+
+
+def publish_country(info, country, result, fingerprints, manifest):
+    '''Create a generated dataset and its showcase in HDX. With manifest, a dataset whose resource files are the same
+    as when it was last uploaded is not uploaded so its metadata including dataset_date stays as it was then. The
+    country's fingerprints are only committed once it has been uploaded or found unchanged.'''
+    dataset, showcase, hxl_resource, ordered_resource_names = result
+    if dataset is None:
+        return
+    countryiso = country['iso3']
+    if manifest:
+        resources = sorted(dataset.get_resources(), key=lambda x: ordered_resource_names.index(x['name']))
+        if manifest.is_unchanged(countryiso, manifest.hash_resources(resources)):
+            logger.info(f'Resources for {country["name"]} are unchanged - not uploading')
+            fingerprints.commit(countryiso)
+            return
+    dataset.update_from_yaml()
+    if hxl_resource is None:
+        dataset.preview_off()
+    else:
+        dataset.set_quickchart_resource(hxl_resource)
+    dataset.create_in_hdx(remove_additional_resources=True, hxl_update=False,
+                          updated_by_script='HDX Scraper: FTS', batch=info['batch'])
+    if hxl_resource and 'cluster' not in hxl_resource['name']:
+        hxl_update = True
+    else:
+        hxl_update = False
+    sorted_resources = sorted(dataset.get_resources(), key=lambda x: ordered_resource_names.index(x['name']))
+    dataset.reorder_resources([x['id'] for x in sorted_resources], hxl_update=hxl_update)
+    if hxl_resource and not hxl_update:
+        dataset.generate_resource_view()
+    showcase.create_in_hdx()
+    showcase.add_dataset(dataset)
+    if fingerprints:
+        fingerprints.commit(countryiso)
+        manifest.commit(countryiso)
+
+
 def main():
     '''Generate dataset and create it in HDX'''
 
-    with Download(extra_params_yaml=join(expanduser('~'), '.extraparams.yml'), extra_params_lookup=lookup, rate_limit={'calls': 1, 'period': 1}) as downloader:
+    create_downloader = partial(Download, extra_params_yaml=join(expanduser('~'), '.extraparams.yml'),
+                                extra_params_lookup=lookup)
+    with create_downloader() as downloader:
         args = parse_args()
         configuration = Configuration.read()
-        ftsdownloader = FTSDownload(configuration, downloader, countryisos=args.countries, years=args.years, testfolder=args.testfolder)
-        notes = configuration['notes']
-        today = datetime.now()
-
-        locations = Locations(ftsdownloader)
-        logger.info('Number of country datasets to upload: %d' % len(locations.countries))
-
-        fts = FTS(ftsdownloader, locations, today, notes)
-        for info, country in progress_storing_tempdir('FTS', locations.countries, 'iso3'):
-            folder = info['folder']
-# for testing specific countries only
-#             if nextdict['iso3'] not in ['AFG', 'JOR', 'TUR', 'PHL', 'SDN', 'PSE']:
-#                 continue
-            dataset, showcase, hxl_resource, ordered_resource_names = fts.generate_dataset_and_showcase(folder, country)
-            if dataset is not None:
-                dataset.update_from_yaml()
-                if hxl_resource is None:
-                    dataset.preview_off()
-                else:
-                    dataset.set_quickchart_resource(hxl_resource)
-                dataset.create_in_hdx(remove_additional_resources=True, hxl_update=False,
-                                      updated_by_script='HDX Scraper: FTS', batch=info['batch'])
-                if hxl_resource and 'cluster' not in hxl_resource['name']:
-                    hxl_update = True
+        if args.cache_dir:
+            cache = FTSCache(args.cache_dir, max_size=args.cache_max_size * 1048576)
+        else:
+            cache = None
+        if args.record_archive:
+            archive = ResponseArchive(args.record_archive)
+        else:
+            archive = None
+        memory = None
+        ftsdownloader = None
+        try:
+            if args.no_checkpoint:
+                checkpoint = None
+            else:
+                # kept in the progress storing tempdir so it is removed along with it once the countries are done
+                checkpoint = FTSCheckpoint(join(get_temp_dir('FTS'), 'checkpoint'))
+            ftsdownloader = FTSDownload(configuration, downloader, countryisos=args.countries, years=args.years,
+                                        testfolder=args.testfolder, cache=cache, archive=archive,
+                                        checkpoint=checkpoint, create_downloader=create_downloader,
+                                        rate_limit={'calls': 1, 'period': 1})
+            notes = configuration['notes']
+            today = datetime.now()
+
+            if args.refresh_locations:
+                snapshot_ttl = 0
+            else:
+                snapshot_ttl = locations_snapshot_ttl
+            locations = Locations(ftsdownloader, snapshot_path=join(get_temp_dir('FTS-state'), 'locations.json'),
+                                  snapshot_ttl=snapshot_ttl)
+            logger.info('Number of country datasets to upload: %d' % len(locations.countries))
+
+            if args.incremental:
+                statefolder = get_temp_dir('FTS-state')
+                fingerprints = Fingerprints(join(statefolder, 'fingerprints.json'), full=args.full)
+                manifest = Fingerprints(join(statefolder, 'resources.json'), full=args.full)
+                covid_funding_path = join(statefolder, 'covid_funding.json')
+            else:
+                fingerprints = None
+                manifest = None
+                covid_funding_path = None
+            if args.memory_accounting or args.memory_budget:
+                if args.memory_budget:
+                    memory = MemoryAccounting(args.memory_budget * 1048576)
                 else:
-                    hxl_update = False
-                sorted_resources = sorted(dataset.get_resources(), key=lambda x: ordered_resource_names.index(x['name']))
-                dataset.reorder_resources([x['id'] for x in sorted_resources], hxl_update=hxl_update)
-                if hxl_resource and not hxl_update:
-                    dataset.generate_resource_view()
-                showcase.create_in_hdx()
-                showcase.add_dataset(dataset)
+                    memory = MemoryAccounting()
+            fts = FTS(ftsdownloader, locations, today, notes, flow_spill_rows=args.flow_spill_rows,
+                      bulk_flows=args.bulk_flows, fingerprints=fingerprints, flow_years=args.flow_years,
+                      partitions_folder=args.partitions_dir or get_temp_dir('FTS-partitions'),
+                      covid_funding_path=covid_funding_path, memory=memory, parquet=args.parquet)
+            failures = dict()
+            batch = None
+            for info, country, result in generate_countries(fts, locations.countries, args.workers,
+                                                            args.publish_queue, failures):
+                batch = info['batch']
+                if result is None:
+                    continue
+                try:
+                    publish_country(info, country, result, fingerprints, manifest)
+                except Exception as ex:
+                    logger.exception(f'Publishing {country["name"]} failed!')
+                    failures[country['iso3']] = f'publishing: {ex}'
+            # the progress storing tempdir has been removed so responses checkpointed now would never be removed and
+            # would answer the same requests in later runs
+            ftsdownloader.checkpoint = None
+            # combining only some countries would be misleading
+            if not args.countries and not args.no_global:
+                try:
+                    with temp_dir('FTS-global') as folder:
+                        result = fts.generate_global_dataset(folder, locations.countries)
+                        publish_country({'batch': batch}, allcountries, result, None, None)
+                except Exception as ex:
+                    logger.exception('Publishing global dataset failed!')
+                    failures[allcountries['iso3']] = f'global dataset: {ex}'
+            logger.info(f'Plan results: {fts.planresults.get_summary()}')
+            if fingerprints:
+                logger.info(f'Countries skipped as unchanged: {fingerprints.unchanged}')
+                logger.info(f'Uploads avoided as resources unchanged: {manifest.unchanged}')
+            if cache:
+                logger.info(f'FTS response cache: {cache.hits} hits, {cache.misses} misses')
+            if checkpoint:
+                logger.info(f'FTS responses reused from checkpoint: {checkpoint.hits}')
+            logger.info(f'FTS requests: {ftsdownloader.stats.get_summary()}')
+            if memory:
+                logger.info(f'Memory: {memory.get_summary()}')
+            if args.request_report:
+                makedirs(args.request_report, exist_ok=True)
+                ftsdownloader.stats.save(join(args.request_report, 'fts_requests.json'),
+                                         join(args.request_report, 'fts_requests.prom'))
+                if memory:
+                    memory.save(join(args.request_report, 'fts_memory.json'))
+            if failures:
+                for countryiso, failure in failures.items():
+                    logger.error(f'{countryiso} failed in {failure}')
+                raise FTSException(f'{len(failures)} countries failed: {", ".join(failures)}')
+        finally:
+            # the index is written on closing so close the archive even if the run fails
+            if archive:
+                archive.close()
+                logger.info(f'Recorded {len(archive.index)} FTS responses in {args.record_archive}')
+            if memory:
+                memory.stop()
+            if ftsdownloader:
+                ftsdownloader.close()
 
 
 if __name__ == '__main__':
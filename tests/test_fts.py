@@ -4,38 +4,83 @@
 Unit tests for fts.
 
 '''
+import json
 import logging
-from datetime import datetime
-from os.path import join
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import partial
+from hashlib import sha256
+from os import listdir, makedirs
+from os.path import exists, join
+from threading import Lock
 
 import pytest
 from hdx import hdx_locations
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
 from hdx.data.vocabulary import Vocabulary
 from hdx.hdx_configuration import Configuration
 from hdx.location.country import Country
 from hdx.utilities.compare import assert_files_same
 from hdx.utilities.dateparse import parse_date
-from hdx.utilities.downloader import Download
+from hdx.utilities.downloader import DownloadError
 from hdx.utilities.path import temp_dir
 
-from fts.download import FTSDownload
+from fts.archive import ResponseArchive, ReplayDownload, ReplayResponse
+from fts.download import FTSDownload, FTSCache, FTSCheckpoint, FTSException, hour, day
+from fts.fingerprints import Fingerprints
+from fts.flows import Flows, get_column_plan, flow_column_index
+from fts.helpers import hxl_names, write_resource_from_iterator
 from fts.locations import Locations
 from fts.main import FTS
+from fts.memory import MemoryAccounting
+from fts.planresults import PlanResults
+from fts.requeststats import RequestStats, get_endpoint_family
+from fts.requirements_funding import RequirementsFunding
+from fts.requirements_funding_cluster import RequirementsFundingCluster
+from fts.requirements_funding_covid import RequirementsFundingCovid
+from fts.rowstore import DerivedRow, ExternalSorter, RowFile, RowSpool, dump_row, get_first_row
+from run import generate_countries, publish_country
 
 logger = logging.getLogger(__name__)
 
 
+class SlowReplayDownload(ReplayDownload):
+    '''Keeps the response it is returning on itself like hdx Download, slowly enough for concurrent calls to mix up
+    their responses if they are not made one at a time'''
+
+    def download(self, url):
+        self.response = None
+        time.sleep(0.001)
+        self.response = super().download(url)
+        time.sleep(0.001)
+        return self.response
+
+
 class TestFTS:
     @pytest.fixture(scope='function')
     def configuration(self):
         Configuration._create(hdx_read_only=True, user_agent='test',
                               project_config_yaml=join('tests', 'config', 'project_configuration.yml'))
-        hdx_locations.Locations.set_validlocations([{'name': 'afg', 'title': 'Afghanistan'}, {'name': 'jor', 'title': 'Jordan'}, {'name': 'pse', 'title': 'occupied Palestinian territory'}])
+        hdx_locations.Locations.set_validlocations([{'name': 'afg', 'title': 'Afghanistan'}, {'name': 'jor', 'title': 'Jordan'}, {'name': 'pse', 'title': 'occupied Palestinian territory'}, {'name': 'world', 'title': 'World'}])
         Country.countriesdata(False)
         Vocabulary._approved_vocabulary = {'tags': [{'name': 'hxl'}, {'name': 'financial tracking service - fts'}, {'name': 'aid funding'}, {'name': 'epidemics and outbreaks'}, {'name': 'covid-19'}], 'id': '4e61d464-4943-4e97-973a-84673c1aaa87', 'name': 'approved'}
+        Vocabulary.set_tagsdict({tag['name']: {'Action to Take': 'ok', 'New Tag(s)': tag['name']}
+                                 for tag in Vocabulary._approved_vocabulary['tags']})
         return Configuration.read()
 
-    def test_generate_dataset_and_showcase(self, configuration):
+    @pytest.fixture(scope='class')
+    def archive_path(self):
+        with temp_dir('FTS-TEST-RESPONSES') as folder:
+            path = join(folder, 'responses.zip')
+            with ResponseArchive(path) as archive:
+                archive.add_folder(join('tests', 'fixtures', 'input'))
+            yield path
+
+    def test_generate_dataset_and_showcase(self, configuration, archive_path):
 
         def check_resources(dsresources):
             for resource in dsresources:
@@ -45,7 +90,7 @@ class TestFTS:
                 assert_files_same(expected_file, actual_file)
 
         with temp_dir('FTS-TEST', delete_on_failure=False) as folder:
-            with Download(user_agent='test') as downloader:
+            with ReplayDownload(archive_path) as downloader:
                 ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
                 notes = configuration['notes']
                 today = parse_date('2020-10-12')
@@ -166,3 +211,787 @@ class TestFTS:
                              {'name': 'covid-19', 'vocabulary_id': '4e61d464-4943-4e97-973a-84673c1aaa87'}]}
                 assert hxl_resource == resources[5]
                 assert ordered_resource_names == ['fts_requirements_funding_pse.csv', 'fts_requirements_funding_covid_pse.csv', 'fts_requirements_funding_cluster_pse.csv', 'fts_requirements_funding_globalcluster_pse.csv', 'fts_incoming_funding_pse.csv', 'fts_internal_funding_pse.csv', 'fts_outgoing_funding_pse.csv']
+
+                dataset, showcase, hxl_resource, ordered_resource_names = fts.generate_global_dataset(folder, locations.countries)
+                assert dataset['name'] == 'fts-requirements-and-funding-data-for-all-countries'
+                assert dataset['groups'] == [{'name': 'world'}]
+                assert ordered_resource_names == ['fts_requirements_funding_all.csv', 'fts_requirements_funding_covid_all.csv', 'fts_requirements_funding_cluster_all.csv', 'fts_requirements_funding_globalcluster_all.csv']
+                assert hxl_resource['name'] == 'fts_requirements_funding_cluster_all.csv'
+                # the global resources are the country resources one after another
+                for resource_name in ordered_resource_names:
+                    expected_lines = list()
+                    for countryiso in ('afg', 'jor', 'pse'):
+                        with open(join('tests', 'fixtures', resource_name.replace('_all', f'_{countryiso}'))) as f:
+                            lines = f.readlines()
+                        if not expected_lines:
+                            expected_lines.extend(lines[:2])
+                        expected_lines.extend(lines[2:])
+                    with open(join(folder, resource_name)) as f:
+                        assert f.readlines() == expected_lines
+
+    def test_generate_countries(self, configuration, archive_path, monkeypatch):
+        def generate(workers):
+            contents = dict()
+            with SlowReplayDownload(archive_path) as downloader:
+                # concurrent requests each have their own downloader
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True,
+                                            create_downloader=partial(SlowReplayDownload, archive_path))
+                locations = Locations(ftsdownloader)
+                fts = FTS(ftsdownloader, locations, parse_date('2020-10-12'), configuration['notes'], start_year=2019)
+                for info, country, result in generate_countries(fts, locations.countries, workers):
+                    for resource_name in result[3]:
+                        with open(join(info['folder'], resource_name), 'rb') as f:
+                            contents[resource_name] = f.read()
+                ftsdownloader.close()
+            return contents
+
+        with temp_dir('FTS-TEST-WORKERS') as folder:
+            monkeypatch.setenv('TEMP_DIR', folder)
+            contents = generate(1)
+            assert len(contents) == 19
+            assert generate(3) == contents
+
+    def test_bulk_flows(self, configuration):
+        test_url = configuration['test_url']
+        flows = dict()
+        for filename in listdir(join('tests', 'fixtures', 'input')):
+            if filename.startswith('flow_locationid='):
+                with open(join('tests', 'fixtures', 'input', filename)) as f:
+                    for flow in json.load(f)['data']['flows']:
+                        flows[flow['id']] = {key: value for key, value in flow.items()
+                                             if key not in ('boundary', 'onBoundary')}
+        # flows of the year for all locations as the API returns them, without boundaries, over two pages
+        flows = sorted(flows.values(), key=lambda k: k['id'], reverse=True)
+        half = len(flows) // 2
+        pages = {'flow_year=2020.json': {'status': 'ok', 'data': {'flows': flows[:half]},
+                                         'meta': {'nextLink': f'{test_url}flow_year=2020&page=2.json'}},
+                 'flow_year=2020&page=2.json': {'status': 'ok', 'data': {'flows': flows[half:]}, 'meta': {}}}
+        with temp_dir('FTS-TEST-BULK-FLOWS') as folder:
+            path = join(folder, 'responses.zip')
+            with ResponseArchive(path) as archive:
+                archive.add_folder(join('tests', 'fixtures', 'input'))
+                for name, page in pages.items():
+                    archive.add(f'{test_url}{name}', name, page)
+            resource_names = dict()
+            for bulk_flows in (False, True):
+                resource_names[bulk_flows] = list()
+                bulkfolder = join(folder, str(bulk_flows))
+                makedirs(bulkfolder)
+                with ReplayDownload(path) as downloader:
+                    ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                    locations = Locations(ftsdownloader)
+                    fts = FTS(ftsdownloader, locations, parse_date('2020-10-12'), configuration['notes'],
+                              start_year=2019, bulk_flows=bulk_flows)
+                    for country in locations.countries:
+                        _, _, _, ordered_resource_names = fts.generate_dataset_and_showcase(bulkfolder, country)
+                        resource_names[bulk_flows].extend(name for name in ordered_resource_names
+                                                          if 'requirements' not in name)
+                    assert (fts.flows.flows_by_locationid is not None) == bulk_flows
+            assert resource_names[True] == resource_names[False]
+            assert len(resource_names[True]) == 7
+            for resource_name in resource_names[True]:
+                assert_files_same(join(folder, 'False', resource_name), join(folder, 'True', resource_name))
+
+    def test_incremental(self, configuration, archive_path):
+        class ChangedDownload(ReplayDownload):
+            '''Changes the responses of urls containing change'''
+
+            def __init__(self, path, change):
+                super().__init__(path)
+                self.change = change
+
+            def download(self, url):
+                response = super().download(url)
+                if self.change is None or self.change not in url:
+                    return response
+                origjson = json.loads(response.content)
+                data = origjson['data']
+                if isinstance(data, list):
+                    data.append({'year': 2001, 'totalFunding': 1})
+                else:
+                    data['requirements']['objects'].append({'id': 99999, 'name': 'New', 'revisedRequirements': 1})
+                return ReplayResponse(json.dumps(origjson).encode('utf-8'))
+
+        def generate(full=False, change=None):
+            fingerprints = Fingerprints(path, full=full)
+            with ChangedDownload(archive_path, change) as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader)
+                fts = FTS(ftsdownloader, locations, parse_date('2020-10-12'), configuration['notes'],
+                          start_year=2019, fingerprints=fingerprints)
+                dataset = fts.generate_dataset_and_showcase(folder, locations.countries[0])[0]
+            return fingerprints, dataset
+
+        with temp_dir('FTS-TEST-INCREMENTAL') as folder:
+            path = join(folder, 'fingerprints.json')
+            fingerprints, dataset = generate()
+            assert dataset is not None
+            # not published so generated again
+            fingerprints, dataset = generate()
+            assert dataset is not None
+            fingerprints.commit('AFG')
+            fingerprints, dataset = generate()
+            assert dataset is None
+            assert fingerprints.unchanged == 1
+            fingerprints, dataset = generate(full=True)
+            assert dataset is not None
+            assert fingerprints.unchanged == 0
+            fingerprint = fingerprints.pending['AFG']
+            assert fingerprints.is_unchanged('AFG', 'changed') is False
+            fingerprints.commit('AFG')
+            assert Fingerprints(path).fingerprints == {'AFG': 'changed'}
+            assert Fingerprints(path).is_unchanged('AFG', fingerprint) is False
+            fingerprints, dataset = generate()
+            fingerprints.commit('AFG')
+            # changes to data other than flows and plans that resources are generated from are picked up
+            for change in ('groupby-cluster', 'groupby-globalcluster', 'summary-trends'):
+                fingerprints, dataset = generate(change=change)
+                assert dataset is not None, change
+                assert fingerprints.unchanged == 0
+            fingerprints, dataset = generate()
+            assert dataset is None
+
+    def test_generate_countries_pipeline(self, monkeypatch):
+        class Downloader:
+            stats = RequestStats()
+            checkpoint = None
+
+        class StubFTS:
+            downloader = Downloader()
+
+            def __init__(self):
+                self.generated = list()
+
+            def generate_dataset_and_showcase(self, folder, country):
+                self.generated.append(country['iso3'])
+                if country['iso3'] == 'B':
+                    raise ValueError('generation failed')
+                return country['iso3'], None, None, list()
+
+        countries = [{'iso3': iso3, 'name': iso3} for iso3 in 'ABCDE']
+        with temp_dir('FTS-TEST-PIPELINE') as folder:
+            monkeypatch.setenv('TEMP_DIR', folder)
+            monkeypatch.delenv('WHERETOSTART', raising=False)
+            fts = StubFTS()
+            failures = dict()
+            yielded = list()
+            with pytest.raises(ValueError):
+                for i, (info, country, result) in enumerate(generate_countries(fts, countries, 1, 1, failures)):
+                    # give the worker time to run ahead
+                    time.sleep(0.05)
+                    # generation runs ahead of the caller by the queue size plus the workers but no further
+                    assert fts.generated == [country['iso3'] for country in countries[:i + 2]]
+                    if country['iso3'] == 'D':
+                        raise ValueError('publishing failed')
+                    yielded.append((country['iso3'], result))
+            # a failed generation is reported and the run goes on
+            assert yielded == [('A', ('A', None, None, list())), ('B', None), ('C', ('C', None, None, list()))]
+            assert failures == {'B': 'generation: generation failed'}
+            # a resumed run starts from the country that was being published
+            fts = StubFTS()
+            iso3s = [country['iso3'] for _, country, _ in generate_countries(fts, countries, 2, 1, dict())]
+            assert iso3s == ['D', 'E']
+            assert sorted(fts.generated) == ['D', 'E']
+
+    def test_publish_country(self, configuration):
+        class HDXDataset:
+            def __init__(self, resources, fail=False):
+                self.resources = resources
+                self.fail = fail
+                self.created = False
+
+            def get_resources(self):
+                return self.resources
+
+            def update_from_yaml(self):
+                pass
+
+            def preview_off(self):
+                pass
+
+            def create_in_hdx(self, **kwargs):
+                if self.fail:
+                    raise HDXError('upload failed')
+                self.created = True
+
+            def reorder_resources(self, resource_ids, hxl_update):
+                assert resource_ids == ['2', '1']
+
+        class HDXShowcase:
+            def create_in_hdx(self):
+                pass
+
+            def add_dataset(self, dataset):
+                pass
+
+        def publish(fingerprint, fail=False, full=False):
+            fingerprints = Fingerprints(join(folder, 'fingerprints.json'))
+            manifest = Fingerprints(join(folder, 'resources.json'), full=full)
+            fingerprints.is_unchanged('AFG', fingerprint)
+            dataset = HDXDataset(resources, fail)
+            try:
+                publish_country({'batch': None}, {'iso3': 'AFG', 'name': 'Afghanistan'},
+                                (dataset, HDXShowcase(), None, ordered_resource_names), fingerprints, manifest)
+            except HDXError:
+                pass
+            return dataset.created, Fingerprints(join(folder, 'fingerprints.json')).fingerprints.get('AFG'), \
+                Fingerprints(join(folder, 'resources.json')).fingerprints.get('AFG')
+
+        with temp_dir('FTS-TEST-PUBLISH') as folder:
+            resources = list()
+            for i, name in enumerate(('fts_incoming_funding_afg.csv', 'fts_requirements_funding_afg.csv')):
+                with open(join(folder, name), 'w') as f:
+                    f.write('a,b\n1,2\n')
+                resource = Resource({'id': str(i + 1), 'name': name})
+                resource.set_file_to_upload(join(folder, name))
+                resources.append(resource)
+            ordered_resource_names = ['fts_requirements_funding_afg.csv', 'fts_incoming_funding_afg.csv']
+            assert Fingerprints.hash_resources(resources) != Fingerprints.hash_resources(resources[::-1])
+            created, fingerprint, resources_hash = publish('1')
+            assert created is True
+            assert fingerprint == '1'
+            assert resources_hash == Fingerprints.hash_resources(resources[::-1])
+            # flows changed but not the files
+            assert publish('2') == (False, '2', resources_hash)
+            assert publish('3', full=True) == (True, '3', resources_hash)
+            with open(join(folder, 'fts_incoming_funding_afg.csv'), 'a') as f:
+                f.write('3,4\n')
+            # nothing is committed until the upload succeeds
+            assert publish('4', fail=True) == (False, '3', resources_hash)
+            created, fingerprint, changed_hash = publish('4')
+            assert (created, fingerprint) == (True, '4')
+            assert changed_hash != resources_hash
+
+    def test_cache(self):
+        with temp_dir('FTS-TEST-CACHE') as folder:
+            cache = FTSCache(folder, max_size=60)
+            assert cache.get_ttl('https://api.hpc.tools/v1/public/location') == 7 * day
+            assert cache.get_ttl('https://api.hpc.tools/v2/fts/flow/plan/overview/progress/2010') == 7 * day
+            assert cache.get_ttl(f'https://api.hpc.tools/v2/fts/flow/plan/overview/progress/{datetime.now().year}') == hour
+            # the previous year is still changing
+            assert cache.get_ttl(f'https://api.hpc.tools/v1/public/fts/flow?locationid=1&year={datetime.now().year - 1}') == hour
+            assert cache.get_ttl(f'https://api.hpc.tools/v1/public/fts/flow?locationid=1&year={datetime.now().year - 2}') == 7 * day
+            assert cache.get_ttl('https://api.hpc.tools/v1/public/fts/flow?planid=1010&groupby=cluster') == hour
+            assert cache.get('https://a') is None
+            cache.set('https://a', b'{"status": "ok"}')
+            assert cache.get('https://a') == b'{"status": "ok"}'
+            cache.set('https://b', b'{"status": "ok", "data": []}')
+            assert cache.get('https://a') is None
+            assert cache.get('https://b') == b'{"status": "ok", "data": []}'
+            assert len(listdir(folder)) == 1
+            assert cache.hits == 2
+            assert cache.misses == 2
+
+    def test_external_sorter(self):
+        with temp_dir('FTS-TEST-SORTER') as folder:
+            rows = [{'date': date, 'id': i} for i, date in enumerate(['2020-01-03', '2020-01-01', '2020-01-03',
+                                                                     '2020-01-02', '2020-01-01', '2020-01-03'])]
+            sorter = ExternalSorter(key=lambda k: k['date'], reverse=True, max_rows=2, folder=folder)
+            for row in rows:
+                sorter.append(row)
+            assert len(sorter.runs) == 3
+            assert list(sorter) == sorted(rows, key=lambda k: k['date'], reverse=True)
+            path = join(folder, 'rows.jsonl')
+            sorter.save(path)
+            sorter.close()
+            assert listdir(folder) == ['rows.jsonl']
+            assert list(RowFile(path)) == sorted(rows, key=lambda k: k['date'], reverse=True)
+
+    def test_write_flows_failure(self, configuration, monkeypatch):
+        def write_resource_from_iterator(*args, **kwargs):
+            raise ValueError('write failed')
+
+        with temp_dir('FTS-TEST-WRITE-FLOWS') as folder:
+            flows = Flows(FTSDownload(configuration, None), None, dict())
+            fund_boundaries_info = dict()
+            for boundary in ('incoming', 'outgoing'):
+                rows = ExternalSorter(key=lambda k: k['date'], max_rows=1, folder=folder)
+                for row in ({'date': '2020-01-02'}, {'date': '2020-01-01'}):
+                    rows.append(row)
+                fund_boundaries_info[boundary] = rows
+            assert len(listdir(folder)) == 4
+            monkeypatch.setattr('fts.flows.write_resource_from_iterator', write_resource_from_iterator)
+            with pytest.raises(ValueError):
+                flows.write_resources(fund_boundaries_info, folder, Dataset({'name': 'test'}), '2020',
+                                      {'iso3': 'AFG', 'name': 'Afghanistan'})
+            assert listdir(folder) == list()
+
+    def test_other_rows_failure(self, configuration, archive_path, monkeypatch):
+        def generate_resource(*args):
+            raise ValueError('write failed')
+
+        monkeypatch.setattr('fts.rowstore.budget_check_rows', 1)
+        memory = MemoryAccounting(0)
+        try:
+            with ReplayDownload(archive_path) as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader)
+                fts = FTS(ftsdownloader, locations, parse_date('2020-10-12'), configuration['notes'],
+                          start_year=2019, memory=memory)
+                monkeypatch.setattr(fts.others['covid'], 'generate_resource', generate_resource)
+                with temp_dir('FTS-TEST-OTHER-ROWS') as folder:
+                    with pytest.raises(ValueError):
+                        fts.generate_dataset_and_showcase(folder, locations.countries[0])
+                    with pytest.raises(ValueError):
+                        fts.generate_global_dataset(folder, locations.countries)
+                    # the rows of the other resources were moved to disk and have been removed
+                    assert memory.spills > 0
+                    assert [filename for filename in listdir(folder) if filename.endswith('.jsonl')] == list()
+        finally:
+            memory.stop()
+
+    def test_flow_partitions(self, configuration, archive_path):
+        with open(join('tests', 'fixtures', 'input', 'flow_locationid=1&year=2020.json')) as f:
+            recorded_flows = json.load(f)['data']['flows']
+
+        class Downloader:
+            countryisos = None
+            max_concurrent = 2
+
+            def __init__(self):
+                self.urls = list()
+
+            def get_url(self, partial_url):
+                return partial_url
+
+            def download(self, url, data, select):
+                self.urls.append(url)
+                if url.endswith('2017'):
+                    raise FTSException(f'{url} failed!')
+                return {'meta': dict(), 'data': {'flows': recorded_flows}}
+
+        def collect():
+            downloader.urls = list()
+            fingerprint = sha256()
+            rows_by_year = flows.collect_years(folder, partitions_folder, country, '2020', ['2019', '2018'],
+                                               fingerprint)
+            rows_by_year = {year: {boundary: [list(row) for row in rows] for boundary, rows in info.items()}
+                            for year, info in rows_by_year.items()}
+            return rows_by_year, sorted(url[-4:] for url in downloader.urls), fingerprint.hexdigest()
+
+        def set_created(year, created):
+            path = join(partitions_folder, 'AFG', year, 'partition.json')
+            with open(path) as f:
+                info = json.load(f)
+            info['created'] = created
+            with open(path, 'w') as f:
+                json.dump(info, f)
+
+        with ReplayDownload(archive_path) as downloader:
+            locations = Locations(FTSDownload(configuration, downloader, testpath=True))
+        country = locations.countries[0]
+        downloader = Downloader()
+        flows = Flows(downloader, locations, dict())
+        with temp_dir('FTS-TEST-PARTITIONS') as folder:
+            partitions_folder = join(folder, 'partitions')
+            rows_by_year, years, digest = collect()
+            assert list(rows_by_year) == ['2020', '2019', '2018']
+            assert years == ['2018', '2019', '2020']
+            assert sorted(rows_by_year['2020']) == ['incoming', 'internal']
+            assert rows_by_year['2019'] == rows_by_year['2020']
+            assert rows_by_year['2018'] == rows_by_year['2020']
+            rows, partition_digest = Flows.load_partition(join(partitions_folder, 'AFG', '2019'))
+            assert {boundary: list(rows) for boundary, rows in rows.items()} == rows_by_year['2019']
+            # completed past years are reused
+            assert collect() == (rows_by_year, ['2020'], digest)
+            # the previous year is downloaded again sooner than earlier years
+            set_created('2019', time.time() - 2 * day)
+            set_created('2018', time.time() - 2 * day)
+            assert collect() == (rows_by_year, ['2019', '2020'], digest)
+            set_created('2018', 0)
+            assert collect() == (rows_by_year, ['2018', '2020'], digest)
+            assert Flows.load_partition(join(partitions_folder, 'AFG', '2019'))[1] == partition_digest
+            assert sorted(listdir(join(partitions_folder, 'AFG'))) == ['2018', '2019']
+            # the spill files of years collected are removed if another year fails
+            flows = Flows(downloader, locations, dict(), spill_rows=2)
+            with pytest.raises(FTSException):
+                flows.collect_years(folder, partitions_folder, country, '2020', ['2017'])
+            assert listdir(folder) == ['partitions']
+
+    def test_memory_budget(self):
+        with temp_dir('FTS-TEST-MEMORY') as folder:
+            memory = MemoryAccounting(budget=0)
+            rows = [{'id': i, 'name': f'row {i}'} for i in range(2500)]
+            with memory.stage('rows'):
+                spool = RowSpool(folder, memory)
+                spool.extend(rows)
+                assert spool.path is not None
+                assert len(spool) == 2500
+                assert list(spool) == rows
+                assert get_first_row(spool) == rows[0]
+                sorter = ExternalSorter(key=lambda k: k['id'], reverse=True, folder=folder, memory=memory)
+                for row in rows:
+                    sorter.append(row)
+                assert sorter.max_rows == 1000
+                assert len(sorter.runs) == 2
+                assert list(sorter) == sorted(rows, key=lambda k: k['id'], reverse=True)
+                spool.close()
+                sorter.close()
+            assert listdir(folder) == list()
+            spool = RowSpool(folder, MemoryAccounting())
+            spool.extend(rows)
+            assert spool.path is None
+            assert list(spool) == rows
+            report = memory.get_report()
+            assert report['spills'] == 2
+            assert report['stages']['rows']['all']['spilled'] is True
+            assert report['countries']['all']['stage'] == 'rows'
+            # tracing is stopped by what started it
+            spool.memory.stop()
+            assert tracemalloc.is_tracing() is True
+            memory.stop()
+            assert tracemalloc.is_tracing() is False
+        closed = list()
+
+        def generate_rows():
+            try:
+                yield from rows
+            finally:
+                closed.append(True)
+
+        assert get_first_row(generate_rows()) == rows[0]
+        assert closed == [True]
+
+    def test_derived_row(self):
+        base = {'countryCode': 'AFG', 'id': 1, 'typeId': 4, 'requirements': 100, 'funding': 50, 'year': 2020}
+        row = RequirementsFundingCluster.create_row(base, 3, 'Health', 20)
+        assert list(row.keys()) == ['countryCode', 'id', 'year', 'clusterCode', 'cluster', 'requirements', 'funding',
+                                    'percentFunded']
+        assert row['requirements'] == 20
+        assert row.get('typeId') is None
+        row['percentFunded'] = 10
+        assert dict(row) == {'countryCode': 'AFG', 'id': 1, 'year': 2020, 'clusterCode': 3, 'cluster': 'Health',
+                             'requirements': 20, 'funding': '', 'percentFunded': 10}
+        row = DerivedRow(base, {'funding': 10, 'percentFunded': 10})
+        assert list(row.items()) == [('countryCode', 'AFG'), ('id', 1), ('typeId', 4), ('requirements', 100),
+                                     ('funding', 10), ('year', 2020), ('percentFunded', 10)]
+        assert base['funding'] == 50
+        assert json.loads(dump_row(row)) == dict(row)
+
+    def test_plan_results(self):
+        planresults = PlanResults()
+        calls = list()
+
+        def download():
+            calls.append(1)
+            time.sleep(0.01)
+            return {'objects': len(calls)}
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: planresults.get('cluster', 929, download), range(4)))
+        assert results == [{'objects': 1}] * 4
+        assert planresults.get('cluster', 929, download) == {'objects': 1}
+        assert planresults.get('globalcluster', 929, download) == {'objects': 2}
+        assert len(calls) == 2
+        assert planresults.key_locks == dict()
+        assert planresults.get_summary() == 'cluster: 1 calls, 4 saved, globalcluster: 1 calls, 0 saved'
+
+    def test_requirements_funding_years(self):
+        class Downloader:
+            @staticmethod
+            def download(url, use_v2=False):
+                return list()
+
+        def get_plan(requirements, funding):
+            return {'id': 929, 'name': 'Plan', 'code': 'HAFG', 'planType': {'id': 1}, 'startDate': '',
+                    'endDate': '', 'countries': [{'id': 1, 'iso3': 'AFG', 'adminlevel': 0}],
+                    'requirements': {'revisedRequirements': requirements},
+                    'funding': {'totalFunding': funding, 'progress': funding / requirements * 100}}
+
+        plans_by_year = {2020: [get_plan(200, 100)], 2019: [get_plan(100, 25)]}
+        reqfund = RequirementsFunding(Downloader(), None, set(), datetime(2020, 10, 12))
+        # the later year's figures must not be overwritten by the earlier year's
+        for year in (2020, 2019):
+            for plan in plans_by_year[year]:
+                reqfund.add_country_requirements_funding(year, plan['id'], plan, plan['countries'])
+        rows = [row for row in reqfund.get_rows(plans_by_year, {'id': 1, 'iso3': 'AFG'}) if row['id']]
+        assert [(row['year'], row['requirements'], row['funding'], row['percentFunded']) for row in rows] == \
+            [(2020, 200, 100, 50), (2019, 100, 25, 25)]
+
+    def test_request_stats(self):
+        stats = RequestStats()
+        url = 'https://api.hpc.tools/v1/public/fts/flow?locationid=1&year=2020'
+        nexturl = f'{url}&page=2'
+        assert get_endpoint_family(url) == 'fts/flow'
+        assert get_endpoint_family('country/1/summary/trends/2020') == 'country/*/summary/trends'
+        with stats.country('AFG'):
+            stats.record(url, 'fts/flow', 'v1', 0.3, 100, 0.1, 0.02, False, nexturl)
+            stats.record(nexturl, 'fts/flow', 'v1', 0.001, 50, 0.0, 0.01, True, None)
+        stats.record(None, 'location', 'v1', 0.2, 10, 0.0, 0.01, False, None)
+        report = stats.get_report()
+        flows = report['endpoints']['fts/flow']
+        assert flows['requests'] == 2
+        assert flows['cached'] == 1
+        assert flows['bytes'] == 150
+        # reading the cache is not counted as latency
+        assert flows['latency_p50'] == 0.3
+        assert flows['latency_total'] == 0.3
+        assert flows['ratelimit_wait_total'] == 0.1
+        assert flows['processing_total'] == 0.03
+        assert report['countries']['AFG']['requests'] == 2
+        assert report['countries']['all']['requests'] == 1
+        assert report['pagination']['fts/flow']['pages_max'] == 2
+        lines = stats.get_prometheus_lines(report)
+        assert 'fts_endpoint_requests_total{endpoint="fts/flow",version="v1"} 2' in lines
+        assert 'fts_pagination_pages_count{endpoint="fts/flow"} 1' in lines
+        assert 'fts_endpoint_latency_seconds_count{endpoint="fts/flow"} 1' in lines
+
+    def test_column_plan(self):
+        assert get_column_plan('src', 'Organization', 'name') == ('single', 'srcOrganization',
+                                                                  flow_column_index['srcOrganization'], None)
+        assert get_column_plan('dest', 'UsageYear', 'name') == ('years', 'destUsageYearEnd',
+                                                                flow_column_index['destUsageYearEnd'],
+                                                                flow_column_index['destUsageYearStart'])
+        assert get_column_plan('dest', 'Location', 'name') == ('iso3s', 'destLocations',
+                                                               flow_column_index['destLocations'], None)
+        assert get_column_plan('src', 'GlobalCluster', 'name') is None
+
+    def test_filters(self, configuration):
+        ftsdownloader = FTSDownload(configuration, None, countryisos='AFG,JOR', years='2020')
+        plan = {'countries': [{'iso3': 'JOR'}, {'iso3': 'SYR'}], 'usageYears': [{'year': '2019'}, {'year': '2020'}]}
+        assert ftsdownloader.include_plan(plan) is True
+        assert ftsdownloader.include_plan(dict(plan, countries=[{'iso3': 'SYR'}])) is False
+        assert ftsdownloader.include_plan(dict(plan, countries=list())) is True
+        assert ftsdownloader.include_plan(dict(plan, usageYears=[{'year': '2019'}])) is False
+        assert ftsdownloader.include_object({'iso3': 'AFG', 'year': 2020}) is True
+        assert ftsdownloader.include_object({'iso3': 'PSE'}) is False
+        assert ftsdownloader.include_object({'year': 2019}) is False
+        ftsdownloader = FTSDownload(configuration, None, years='2020')
+        assert ftsdownloader.include_object({'iso3': 'PSE', 'year': 2020}) is True
+
+    def test_covid_funding_batches(self):
+        class Downloader:
+            def __init__(self):
+                self.requests = list()
+
+            def download_many(self, requests):
+                self.requests.extend(requests)
+                datas = list()
+                for planids in get_planids(requests):
+                    objects = [{'id': planid, 'totalFunding': funding[planid]}
+                               for planid in map(int, planids.split(',')) if planid in funding]
+                    # there are no objects if no plan in the batch has COVID funding
+                    if objects:
+                        objects = [{'singleFundingObjects': objects}]
+                    datas.append({'report3': {'fundingTotals': {'objects': objects}}})
+                return datas
+
+        def get_planids(requests):
+            return [request['partial_url'].split('planid=')[1].split('&')[0] for request in requests]
+
+        def get_requests():
+            return get_planids(downloader.requests)
+
+        funding = {1: 100, 3: 300}
+        plans_by_year_by_country = {'AFG': {2020: [{'id': 1}, {'id': 2}], 2021: [{'id': 3}], 2022: [{'id': 5}]},
+                                    'JOR': {2019: [{'id': 4}], 2020: [{'id': 2}]}}
+        with temp_dir('FTS-TEST-COVID') as folder:
+            path = join(folder, 'covid_funding.json')
+            downloader = Downloader()
+            covid = RequirementsFundingCovid(downloader, plans_by_year_by_country, None, currentyear=2022,
+                                             known_path=path, batch_size=2)
+            assert downloader.requests[0]['partial_url'] == 'fts/flow?emergencyid=911&planid=1,2&groupby=plan'
+            assert get_requests() == ['1,2', '3,5']
+            assert covid.covidfundingbyplan == {1: 100, 3: 300}
+            downloader = Downloader()
+            covid = RequirementsFundingCovid(downloader, plans_by_year_by_country, None, currentyear=2022,
+                                             known_path=path, batch_size=1)
+            # plans that ended the year before the current one are queried again, a batch with no COVID funding
+            # is skipped
+            assert get_requests() == ['3', '5']
+            assert covid.covidfundingbyplan == {1: 100, 2: 0, 3: 300}
+            with open(path) as f:
+                known_funding = json.load(f)
+            assert [entry[:2] for entry in known_funding] == [[1, 100], [2, 0]]
+            known_funding[0][2] -= 31 * day
+            with open(path, 'w') as f:
+                json.dump(known_funding, f)
+            downloader = Downloader()
+            RequirementsFundingCovid(downloader, plans_by_year_by_country, None, currentyear=2022, known_path=path,
+                                     batch_size=1)
+            assert get_requests() == ['1', '3', '5']
+
+    def test_response_archive(self, configuration):
+        response = {'status': 'ok', 'data': [{'id': 1}], 'meta': {'nextLink': f'{configuration["v1_url"]}location?page=2'}}
+
+        responses = {'location': response, 'organization': {'status': 'ok', 'data': list()},
+                     'progress/2020': {'status': 'ok', 'data': {'plans': [{'id': 1, 'countries': [{'iso3': 'AFG'}],
+                                                                           'usageYears': [{'year': '2020'}]}]}}}
+
+        class Downloader:
+            def download(self, url):
+                for key, value in responses.items():
+                    if url.endswith(key):
+                        return ReplayResponse(json.dumps(value).encode('utf-8'))
+
+        with temp_dir('FTS-TEST-ARCHIVE') as folder:
+            path = join(folder, 'responses.zip')
+            with ResponseArchive(path) as archive:
+                ftsdownloader = FTSDownload(configuration, Downloader(), archive=archive)
+                assert ftsdownloader.download('location') == [{'id': 1}]
+                # responses that are empty or have no plans once filtered are archived too
+                assert ftsdownloader.download('organization') == list()
+                ftsdownloader = FTSDownload(configuration, Downloader(), countryisos='JOR', archive=archive)
+                assert ftsdownloader.download('fts/flow/plan/overview/progress/2020', use_v2=True) == {'plans': []}
+            assert response['meta']['nextLink'] == f'{configuration["v1_url"]}location?page=2'
+            with ReplayDownload(path) as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader)
+                json_object = ftsdownloader.download('location', data=False)
+                assert json_object['meta']['nextLink'] == f'{configuration["test_url"]}location_page=2.json'
+                assert ftsdownloader.download('organization') == list()
+                assert ftsdownloader.download('fts/flow/plan/overview/progress/2020', use_v2=True) == {'plans': []}
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                assert ftsdownloader.download('location') == [{'id': 1}]
+                with pytest.raises(DownloadError):
+                    ftsdownloader.download('plan')
+            with ResponseArchive(path) as archive:
+                archive.add('https://a/location?page=2', 'location_page=2.json', response)
+                archive.add('https://a/location?page=2', 'location_page=2.json', response)
+                with pytest.raises(FTSException):
+                    archive.add('https://b/location?page=2', 'location_page=2.json', response)
+            with ReplayDownload(path) as downloader:
+                assert downloader.index == {'https://a/location?page=2': 'location_page=2.json'}
+
+    def test_download_many(self, configuration, archive_path):
+        partial_urls = [f'fts/flow?planid={planid}&groupby={groupby}' for planid in (832, 929, 943, 1010)
+                        for groupby in ('cluster', 'globalcluster')]
+        active = {'now': 0, 'most': 0, 'created': 0}
+        lock = Lock()
+
+        class OverlapDownload(SlowReplayDownload):
+            def download(self, url):
+                with lock:
+                    active['now'] += 1
+                    active['most'] = max(active['most'], active['now'])
+                try:
+                    time.sleep(0.05)
+                    return super().download(url)
+                finally:
+                    with lock:
+                        active['now'] -= 1
+
+        def create_downloader():
+            active['created'] += 1
+            return OverlapDownload(archive_path)
+
+        def check(datas):
+            for partial_url, data in zip(partial_urls, datas):
+                with open(join('tests', 'fixtures', 'input', FTSDownload.get_testfile_path(partial_url))) as f:
+                    assert data == json.load(f)['data']
+
+        with OverlapDownload(archive_path) as downloader:
+            ftsdownloader = FTSDownload(configuration, downloader, testpath=True, max_concurrent=4)
+            check(ftsdownloader.download_many([{'partial_url': partial_url} for partial_url in partial_urls]))
+            assert active['most'] == 1
+            ftsdownloader = FTSDownload(configuration, downloader, testpath=True, max_concurrent=4,
+                                        create_downloader=create_downloader, rate_limit={'calls': 2, 'period': 0.2})
+            start = time.perf_counter()
+            check(ftsdownloader.download_many([{'partial_url': partial_url} for partial_url in partial_urls]))
+            # 8 requests at 2 every 0.2 seconds
+            assert time.perf_counter() - start >= 0.6
+            assert active['most'] == 2
+            assert 1 <= active['created'] <= 2
+            assert len(ftsdownloader.free_downloaders) == active['created'] + 1
+            ftsdownloader.close()
+            assert ftsdownloader.free_downloaders == [downloader]
+
+    def test_checkpoint(self, configuration):
+        class Downloader:
+            def __init__(self):
+                self.urls = list()
+
+            def download(self, url):
+                self.urls.append(url)
+                return ReplayResponse(json.dumps({'status': 'ok', 'data': [{'id': len(self.urls)}]}).encode('utf-8'))
+
+        with temp_dir('FTS-TEST-CHECKPOINT') as folder:
+            checkpoint = FTSCheckpoint(folder)
+            downloader = Downloader()
+            ftsdownloader = FTSDownload(configuration, downloader, checkpoint=checkpoint)
+            with RequestStats.country('AFG'):
+                assert ftsdownloader.download('fts/flow?locationid=1&year=2020') == [{'id': 1}]
+            assert ftsdownloader.download('location') == [{'id': 2}]
+            # a resumed run
+            ftsdownloader = FTSDownload(configuration, downloader, checkpoint=FTSCheckpoint(folder))
+            with RequestStats.country('AFG'):
+                assert ftsdownloader.download('fts/flow?locationid=1&year=2020') == [{'id': 1}]
+                assert ftsdownloader.download('fts/flow?locationid=1&year=2019') == [{'id': 3}]
+            assert ftsdownloader.download('location') == [{'id': 2}]
+            assert ftsdownloader.checkpoint.hits == 2
+            assert ftsdownloader.stats.get_report()['total']['cached'] == 2
+            ftsdownloader.checkpoint.done('AFG')
+            with RequestStats.country('AFG'):
+                assert ftsdownloader.download('fts/flow?locationid=1&year=2020') == [{'id': 4}]
+            assert len(downloader.urls) == 4
+
+    def test_locations_snapshot(self, configuration, archive_path):
+        with temp_dir('FTS-TEST-LOCATIONS') as folder:
+            path = join(folder, 'locations.json')
+            with ReplayDownload(archive_path) as downloader:
+                ftsdownloader = FTSDownload(configuration, downloader, testpath=True)
+                locations = Locations(ftsdownloader, snapshot_path=path)
+            ftsdownloader = FTSDownload(configuration, None, testpath=True)
+            snapshot = Locations(ftsdownloader, snapshot_path=path)
+            assert snapshot.countries == locations.countries
+            assert snapshot.name_to_iso3 == locations.name_to_iso3
+            assert snapshot.name_to_id == locations.name_to_id
+            assert snapshot.id_to_iso3 == locations.id_to_iso3
+            ftsdownloader = FTSDownload(configuration, None, countryisos='JOR', testpath=True)
+            assert Locations(ftsdownloader, snapshot_path=path).countries == \
+                [country for country in locations.countries if country['iso3'] == 'JOR']
+            url = ftsdownloader.get_url('location')
+            assert Locations.load_snapshot(path, url, 60) is not None
+            assert Locations.load_snapshot(path, url, 0) is None
+            with open(path) as f:
+                contents = f.read()
+            with open(path, 'w') as f:
+                f.write(contents.replace('"AFG"', '"AFX"', 1))
+            assert Locations.load_snapshot(path, url, 60) is None
+
+    def test_parquet(self, configuration):
+        parquet = pytest.importorskip('pyarrow.parquet')
+        headers = ['countryCode', 'id', 'startDate', 'year', 'requirements', 'funding', 'percentFunded']
+        rows = [{'countryCode': 'AFG', 'id': 929, 'startDate': '2020-01-01', 'year': 2020, 'requirements': 1131050820,
+                 'funding': 372094167, 'percentFunded': 33},
+                ('AFG', '', '', 2022, '', 25620568, '')]
+        with temp_dir('FTS-TEST-PARQUET') as folder:
+            dataset = Dataset({'name': 'test'})
+            success, results = write_resource_from_iterator(dataset, headers, rows, hxl_names, folder,
+                                                            'fts_test.csv', {'name': 'fts_test.csv',
+                                                                             'description': 'Test', 'format': 'csv'},
+                                                            parquet=True)
+            assert success is True
+            assert [resource['name'] for resource in dataset.get_resources()] == ['fts_test.csv', 'fts_test.parquet']
+            table = parquet.read_table(join(folder, 'fts_test.parquet'))
+            assert [str(field.type) for field in table.schema] == ['string', 'string', 'date32[day]', 'int64',
+                                                                   'double', 'double', 'int64']
+            assert table.schema.field('percentFunded').metadata == {b'hxl': b'#value+funding+pct'}
+            assert table.to_pylist() == [
+                {'countryCode': 'AFG', 'id': '929', 'startDate': date(2020, 1, 1), 'year': 2020,
+                 'requirements': 1131050820.0, 'funding': 372094167.0, 'percentFunded': 33},
+                {'countryCode': 'AFG', 'id': None, 'startDate': None, 'year': 2022, 'requirements': None,
+                 'funding': 25620568.0, 'percentFunded': None}]
+            dataset = Dataset({'name': 'test'})
+            success, results = write_resource_from_iterator(dataset, headers, [], hxl_names, folder, 'fts_empty.csv',
+                                                            {'name': 'fts_empty.csv', 'description': 'Test',
+                                                             'format': 'csv'}, parquet=True)
+            assert success is False
+            assert not exists(join(folder, 'fts_empty.parquet'))
+            rows = [('AFG', 929, 'Jan 2020', 2020.5, 'lots', 372094167, '33.0')]
+            success, results = write_resource_from_iterator(dataset, headers, rows, hxl_names, folder, 'fts_bad.csv',
+                                                            {'name': 'fts_bad.csv', 'description': 'Test',
+                                                             'format': 'csv'}, parquet=True)
+            assert success is True
+            assert parquet.read_table(join(folder, 'fts_bad.parquet')).to_pylist() == [
+                {'countryCode': 'AFG', 'id': '929', 'startDate': None, 'year': None, 'requirements': None,
+                 'funding': 372094167.0, 'percentFunded': 33}]
+
+            def failing_rows():
+                yield rows[0]
+                raise FTSException('Failed!')
+
+            with pytest.raises(FTSException):
+                write_resource_from_iterator(dataset, headers, failing_rows(), hxl_names, folder, 'fts_fail.csv',
+                                             {'name': 'fts_fail.csv', 'description': 'Test', 'format': 'csv'},
+                                             parquet=True)
+            assert not exists(join(folder, 'fts_fail.parquet'))